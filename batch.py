@@ -0,0 +1,102 @@
+# encoding: utf-8
+"""
+Compiles many ePubs from their specification files in one process (or one
+pool of processes), so that the libraries are only imported once
+"""
+import os
+import sys
+import glob
+import json
+import time
+import traceback
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from compile import compile_epub_from_specification
+
+
+def find_specs(patterns):
+    """Returns the spec files matched by the given glob patterns, or found
+    directly in the given directories"""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.toml")
+        for path in sorted(glob.glob(pattern)):
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def compile_spec(
+        spec_path, output_dir=None, workers=None, compression_threads=None):
+    """Compiles the ePub of the given spec file, with the given number of
+    processes compiling chapters and threads deflating entries (default:
+    those of the spec). Returns a dictionary with the outcome, duration and
+    output size of the build. A failing build is reported in the dictionary
+    instead of raising"""
+    start = time.perf_counter()
+    result = {
+        "spec": spec_path,
+        "target": None,
+        "ok": False,
+        "duration": 0.0,
+        "size": 0,
+        "error": None,
+    }
+    try:
+        import toml
+        spec = toml.load(spec_path)
+        directory = os.path.dirname(os.path.abspath(spec_path))
+        target_path = None
+        if output_dir is not None:
+            target_path = os.path.join(output_dir, "{} - {}.epub".format(
+                spec["title"], spec["author"]))
+        target_path = compile_epub_from_specification(
+            spec, directory, target_path=target_path, workers=workers,
+            compression_threads=compression_threads)
+        result["target"] = target_path
+        result["size"] = os.path.getsize(target_path)
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+        traceback.print_exc()
+    result["duration"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def compile_batch(spec_paths, workers=1, output_dir=None, summary_path=None):
+    """Compiles the ePubs of all the given spec files, with the given number
+    of processes (0 uses every CPU core). A failing book does not stop the
+    others. Returns a summary of every build, which is also written as JSON
+    to the summary path, if any ('-' writes it to stdout)"""
+    if not workers:
+        workers = os.cpu_count() or 1
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    if workers == 1:
+        results = [compile_spec(path, output_dir) for path in spec_paths]
+    else:
+        # The books are already built in parallel, so the chapters are not,
+        # and the entries are deflated while writing
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                compile_spec, spec_paths, repeat(output_dir), repeat(1),
+                repeat(1)))
+
+    succeeded = sum(1 for result in results if result["ok"])
+    summary = {
+        "books": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "duration": round(time.perf_counter() - start, 3),
+    }
+    if summary_path == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif summary_path is not None:
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+    return summary
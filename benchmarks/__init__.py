@@ -0,0 +1,8 @@
+# encoding: utf-8
+"""
+Benchmarks of the ePub compilation library on synthetic corpora, with
+stored baselines to spot performance regressions. Run from the repository:
+
+    python -m benchmarks run --size small
+    python -m benchmarks compare --size small
+"""
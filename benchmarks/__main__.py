@@ -0,0 +1,107 @@
+# encoding: utf-8
+"""Command-line for generating the corpora and running the benchmarks"""
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+
+from benchmarks.corpus import SIZES, write_corpus
+from benchmarks.harness import (
+    CASES, DEFAULT_TOLERANCE, run_benchmarks, load_baselines, save_baselines,
+    compare)
+
+
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), "epub-benchmarks")
+
+
+def generate(size, directory, seed):
+    """Generates the corpus of the given size"""
+    paths = write_corpus(directory, size, seed)
+    print("Corpus in {!r}".format(paths["root"]))
+
+
+def run(size, directory, seed, cases, repeat, save):
+    """Runs the benchmarks, and stores the results as baselines if asked"""
+    paths = write_corpus(directory, size, seed)
+    results = run_benchmarks(
+        paths, os.path.join(directory, "work"), cases=cases, repeat=repeat)
+    if save:
+        save_baselines(size, results)
+        print("Saved the results as the {} baselines".format(size))
+    return results
+
+
+def compare_baselines(size, directory, seed, cases, repeat, tolerance):
+    """Runs the benchmarks and compares them to the stored baselines"""
+    baselines = load_baselines().get(size)
+    if not baselines:
+        return print("No baselines stored for the {} corpus".format(size))
+    results = run(size, directory, seed, cases, repeat, False)
+    regressions = compare(results, baselines, tolerance)
+    for case, measurement, old, new in regressions:
+        print("! {} regressed: {} {} -> {}".format(case, measurement, old, new))
+    if regressions:
+        sys.exit(1)
+    print("No regressions (tolerance: {:.0%})".format(tolerance))
+
+
+def main(args=sys.argv[1:]):
+    """Entry point"""
+    parser = ArgumentParser(description="""Benchmarks of the ePub library.
+        The create and scrape cases need the 'validator' module that
+        spec_validator uses, and are skipped where it is not installed""")
+    subparsers = parser.add_subparsers(title="commands")
+
+    def add_corpus_arguments(sub_parser):
+        sub_parser.add_argument(
+            "-s", "--size", choices=sorted(SIZES), default="small",
+            help="The size of the generated corpus")
+        sub_parser.add_argument(
+            "-d", "--directory", default=DEFAULT_DIRECTORY,
+            help="""Where to generate the corpora and run the benchmarks
+            (a generated corpus is reused)""")
+        sub_parser.add_argument(
+            "--seed", type=int, default=0,
+            help="The seed of the generated corpus")
+
+    def add_run_arguments(sub_parser):
+        add_corpus_arguments(sub_parser)
+        sub_parser.add_argument(
+            "-c", "--cases", nargs="+", choices=sorted(CASES), default=None,
+            help="The benchmarks to run (defaults to all of them)")
+        sub_parser.add_argument(
+            "-r", "--repeat", type=int, default=1,
+            help="How many times to run every benchmark (the best counts)")
+
+    generate_parser = subparsers.add_parser(
+        "generate", description="Generates a corpus")
+    generate_parser.set_defaults(func=generate)
+    add_corpus_arguments(generate_parser)
+
+    run_parser = subparsers.add_parser(
+        "run", description="Runs the benchmarks")
+    run_parser.set_defaults(func=run)
+    add_run_arguments(run_parser)
+    run_parser.add_argument(
+        "--save", action="store_true",
+        help="Store the results as the baselines of the corpus size")
+
+    compare_parser = subparsers.add_parser(
+        "compare", description="""Runs the benchmarks and fails if any is
+        slower or uses more memory than its stored baseline""")
+    compare_parser.set_defaults(func=compare_baselines)
+    add_run_arguments(compare_parser)
+    compare_parser.add_argument(
+        "-t", "--tolerance", type=float, default=DEFAULT_TOLERANCE,
+        help="How much worse than the baseline is a regression (0.25: 25%%)")
+
+    parsed = parser.parse_args(args)
+    if not hasattr(parsed, "func"):
+        parser.print_usage()
+    else:
+        func = parsed.func
+        del(parsed.func)
+        func(**vars(parsed))
+
+if __name__ == '__main__':
+    main()
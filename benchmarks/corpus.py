@@ -0,0 +1,211 @@
+# encoding: utf-8
+"""
+Generators of synthetic workloads: novel-like markdown sources, html
+chapters and folders of image pages. Everything is generated from a seed,
+so that the same size gives the same corpus on every machine
+"""
+import os
+import zlib
+import struct
+import random
+
+
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while someone watches from "
+    "far away and nothing happens at all until the evening comes and the "
+    "old house by the river falls *silent* again"
+).split()
+
+# The sizes of the generated corpora
+SIZES = {
+    "small": {
+        "chapters": 40, "paragraphs": 40, "html_files": 5, "pages": 100,
+        "page_size": (400, 600),
+    },
+    "full": {
+        "chapters": 400, "paragraphs": 60, "html_files": 50, "pages": 2000,
+        "page_size": (800, 1200),
+    },
+}
+
+
+def generate_markdown_source(chapters=200, paragraphs=60, seed=0):
+    """Generates a novel-like markdown source with the given number of
+    chapters, each with some paragraphs, blank lines, sub-headers and lists"""
+    rand = random.Random(seed)
+
+    def sentence():
+        return " ".join(rand.choice(WORDS) for _ in range(rand.randint(8, 30)))
+
+    lines = []
+    for chapter in range(1, chapters + 1):
+        lines.append("# Chapter {}".format(chapter))
+        for paragraph in range(paragraphs):
+            roll = rand.random()
+            if roll < 0.05:
+                lines.append("## Part {}".format(paragraph))
+            elif roll < 0.1:
+                lines.extend("- " + sentence() for _ in range(3))
+            else:
+                lines.append(sentence() + ". " + sentence() + ".")
+            if rand.random() < 0.3:
+                lines.append("")
+    return "\n".join(lines)
+
+
+def generate_html_source(title, paragraphs=60, images=(), seed=0):
+    """Generates a html chapter with the given title and number of
+    paragraphs, referring to some of the given image filenames"""
+    rand = random.Random(seed)
+
+    def sentence():
+        return " ".join(rand.choice(WORDS) for _ in range(rand.randint(8, 30)))
+
+    body = ["<h1>{}</h1>".format(title)]
+    for _ in range(paragraphs):
+        body.append("<p>{}. {}.</p>".format(sentence(), sentence()))
+        if images and rand.random() < 0.1:
+            body.append('<img src="{}" alt="" />'.format(rand.choice(images)))
+    return (
+        "<html>\n<head><title>{}</title></head>\n<body>\n{}\n</body>\n</html>\n"
+    ).format(title, "\n".join(body))
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return (struct.pack(">I", len(data)) + chunk +
+            struct.pack(">I", zlib.crc32(chunk) & 0xffffffff))
+
+
+def generate_png(width, height, seed=0):
+    """Returns the bytes of a grayscale png page of the given size, with
+    some noisy lines of 'text' so that it compresses like a scanned page"""
+    rand = random.Random(seed)
+    blank = b"\0" + b"\xff" * width
+    rows = []
+    for y in range(height):
+        if (y // 12) % 3 == 2 or y < height // 10 or y > height * 9 // 10:
+            rows.append(blank)
+        else:
+            row = bytearray(b"\xff" * width)
+            for _ in range(width // 16):
+                x = rand.randrange(width)
+                row[x] = rand.randrange(128)
+            rows.append(b"\0" + bytes(row))
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", header),
+        _png_chunk(b"IDAT", zlib.compress(b"".join(rows), 6)),
+        _png_chunk(b"IEND", b""),
+    ])
+
+
+def generate_jpeg(width, height, seed=0):
+    """Returns the bytes of a jpeg page of the given size (needs PIL)"""
+    import io
+    from PIL import Image
+    image = Image.open(io.BytesIO(generate_png(width, height, seed)))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=80)
+    return out.getvalue()
+
+
+def has_pil():
+    """Returns whether PIL is installed, which jpeg pages need"""
+    try:
+        import PIL
+        return True
+    except ImportError:
+        return False
+
+
+def write_file(path, data):
+    mode = "wb" if isinstance(data, bytes) else "w"
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def write_image_folder(folder, pages, width, height, seed=0):
+    """Writes the given number of numbered image pages to the folder.
+    Every other page is a jpeg if PIL is installed, the rest are pngs.
+    Returns the paths of the pages"""
+    os.makedirs(folder, exist_ok=True)
+    jpeg = has_pil()
+    paths = []
+    for page in range(1, pages + 1):
+        if jpeg and page % 2 == 0:
+            path = os.path.join(folder, "{}.jpg".format(page))
+            data = generate_jpeg(width, height, seed + page)
+        else:
+            path = os.path.join(folder, "{}.png".format(page))
+            data = generate_png(width, height, seed + page)
+        write_file(path, data)
+        paths.append(path)
+    return paths
+
+
+def write_text_corpus(directory, chapters, paragraphs, html_files, seed=0):
+    """Writes a markdown source, html chapters, a few images and a
+    specification file referring to them all to the given directory.
+    Returns the path of the specification file"""
+    import toml
+    os.makedirs(directory, exist_ok=True)
+    write_file(os.path.join(directory, "cover.png"),
+               generate_png(600, 900, seed))
+    image_files = {}
+    for num in range(1, 6):
+        filename = "figure{}.png".format(num)
+        write_file(os.path.join(directory, filename),
+                   generate_png(300, 200, seed + num))
+        image_files["figure{}".format(num)] = filename
+
+    write_file(os.path.join(directory, "source.md"),
+               generate_markdown_source(chapters, paragraphs, seed))
+    source_files = ["source.md"]
+    for num in range(1, html_files + 1):
+        filename = "extra{}.html".format(num)
+        html = generate_html_source(
+            "Extra {}".format(num), paragraphs,
+            images=sorted(image_files.values()), seed=seed + num)
+        write_file(os.path.join(directory, filename), html)
+        source_files.append(filename)
+
+    spec = {
+        "title": "Benchmark book",
+        "author": "Benchmark author",
+        "cover_file": "cover.png",
+        "source_files": source_files,
+        "language": "en",
+        "tags": ["Benchmark"],
+        "image_files": image_files,
+    }
+    spec_path = os.path.join(directory, "spec.toml")
+    with open(spec_path, "w") as f:
+        toml.dump(spec, f)
+    return spec_path
+
+
+def write_corpus(directory, size="small", seed=0):
+    """Writes the corpus of the given size to the directory, unless it is
+    already there. Returns a dictionary of the paths of its parts"""
+    settings = SIZES[size]
+    root = os.path.join(directory, "{}-{}".format(size, seed))
+    paths = {
+        "root": root,
+        "spec": os.path.join(root, "text", "spec.toml"),
+        "images": os.path.join(root, "images"),
+        "markdown": os.path.join(root, "text", "source.md"),
+    }
+    done = os.path.join(root, ".complete")
+    if os.path.exists(done):
+        return paths
+
+    print("- Generating the {} corpus in {!r}".format(size, root))
+    write_text_corpus(
+        os.path.join(root, "text"), settings["chapters"],
+        settings["paragraphs"], settings["html_files"], seed)
+    width, height = settings["page_size"]
+    write_image_folder(paths["images"], settings["pages"], width, height, seed)
+    write_file(done, "")
+    return paths
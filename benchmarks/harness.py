@@ -0,0 +1,217 @@
+# encoding: utf-8
+"""
+Times the library on the generated corpora. Every case runs in a child
+process of its own, so that its peak memory (the maximum resident set size
+of the process) is not hidden by the cases that ran before it
+"""
+import os
+import sys
+import json
+import time
+import subprocess
+import contextlib
+import importlib.util
+
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_TOLERANCE = 0.25  # How much slower or bigger is a regression
+
+# The modules that cases need besides the ones of the library itself
+CASE_MODULES = {
+    "create": ["validator"],
+    "scrape": ["validator"],  # Scrapes an ePub built like the create case
+}
+
+
+def case_create(paths, workdir):
+    """Compiles the text corpus from its specification"""
+    import toml
+    from compile import compile_epub_from_specification
+    spec = toml.load(paths["spec"])
+    directory = os.path.dirname(paths["spec"])
+    target = os.path.join(workdir, "create.epub")
+    return lambda: compile_epub_from_specification(
+        spec, directory, target_path=target)
+
+
+def case_from_folder(paths, workdir):
+    """Compiles the image corpus as a comic"""
+    from comic import compile_epub_from_folder
+    target = os.path.join(workdir, "from_folder.epub")
+    return lambda: compile_epub_from_folder(paths["images"], path=target)
+
+
+def case_scrape(paths, workdir):
+    """Scrapes the ePub of the text corpus back to markdown"""
+    from scrape_epub import scrape_epub
+    return lambda: scrape_epub(paths["epub"])
+
+
+def case_markdown(engine):
+    def case(paths, workdir):
+        from compile import split_and_compile, load_source_text
+        source_text = load_source_text(paths["markdown"])
+        def run():
+            for _ in split_and_compile(source_text, engine=engine):
+                pass
+        return run
+    case.__doc__ = "Compiles the markdown source with the {!r} engine".format(
+        engine)
+    return case
+
+
+def case_deflate(threads):
+    def case(paths, workdir):
+        from compile import split_and_compile, load_source_text
+        from epub import Epub
+        chapters = list(split_and_compile(load_source_text(paths["markdown"])))
+        target = os.path.join(workdir, "deflate.epub")
+        def run():
+            with Epub("Deflate", "Benchmark", target,
+                      compression={"threads": threads}) as epub:
+                for (title, filename, text) in chapters:
+                    epub.add_chapter(title, filename, text)
+        return run
+    case.__doc__ = (
+        "Writes the compiled chapters of the text corpus, deflating on {}"
+        .format("{} threads".format(threads) if threads else "every core"))
+    return case
+
+
+CASES = {
+    "create": case_create,
+    "from_folder": case_from_folder,
+    "scrape": case_scrape,
+    "markdown_chapter": case_markdown("chapter"),
+    "markdown_line": case_markdown("line"),
+    "deflate_serial": case_deflate(1),
+    "deflate_parallel": case_deflate(0),
+}
+
+
+def missing_modules(case):
+    """Returns the modules that the case needs and that are not installed"""
+    return [name for name in CASE_MODULES.get(case, [])
+            if importlib.util.find_spec(name) is None]
+
+
+def peak_memory_mb():
+    """Returns the peak resident memory of this process in MB, or None where
+    it cannot be measured"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def run_case_here(case, paths, workdir):
+    """Runs the case in this process and returns its measurements. The
+    output of the library is hidden, so that only the timing is measured"""
+    os.chdir(workdir)
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            run = CASES[case](paths, workdir)
+            start = time.perf_counter()
+            run()
+            seconds = time.perf_counter() - start
+    return {"seconds": round(seconds, 3), "peak_mb": peak_memory_mb()}
+
+
+def run_case(case, paths, workdir):
+    """Runs the case in a child process and returns its measurements"""
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.harness", case,
+         json.dumps(paths), workdir],
+        cwd=REPO_DIR, stdout=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise Exception("Benchmark {!r} failed".format(case))
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def prepare(paths, workdir):
+    """Compiles the ePub that the scrape case reads, once per corpus"""
+    paths = dict(paths, epub=os.path.join(paths["root"], "scrape.epub"))
+    if not os.path.exists(paths["epub"]):
+        case_dir = os.path.join(workdir, "prepare")
+        os.makedirs(case_dir, exist_ok=True)
+        run_case("create", paths, case_dir)
+        os.replace(os.path.join(case_dir, "create.epub"), paths["epub"])
+    return paths
+
+
+def run_benchmarks(paths, workdir, cases=None, repeat=1):
+    """Runs the given cases (default: all) on the corpus at the paths, each
+    the given number of times. Returns a dictionary of case -> the fastest
+    time in seconds and the highest peak memory in MB of the runs, without
+    the cases that were skipped for missing modules"""
+    results = {}
+    runnable = []
+    for case in cases or CASES:
+        missing = missing_modules(case)
+        if missing:
+            print("- {:18} skipped, needs {}".format(case, ", ".join(missing)))
+        else:
+            runnable.append(case)
+    if "scrape" in runnable:
+        paths = prepare(paths, workdir)
+    for case in runnable:
+        case_dir = os.path.join(workdir, case)
+        os.makedirs(case_dir, exist_ok=True)
+        runs = [run_case(case, paths, case_dir) for _ in range(repeat)]
+        peaks = [run["peak_mb"] for run in runs if run["peak_mb"] is not None]
+        results[case] = {
+            "seconds": min(run["seconds"] for run in runs),
+            "peak_mb": round(max(peaks), 1) if peaks else None,
+        }
+        print("- {:18} {:8.2f}s {:>8} MB".format(
+            case, results[case]["seconds"], results[case]["peak_mb"]))
+    return results
+
+
+def load_baselines(path=BASELINES_PATH):
+    """Returns the stored baselines, as size -> case -> measurements"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(size, results, path=BASELINES_PATH):
+    """Stores the results as the baselines of the given corpus size"""
+    baselines = load_baselines(path)
+    baselines.setdefault(size, {}).update(results)
+    with open(path, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(results, baselines, tolerance=DEFAULT_TOLERANCE):
+    """Compares the results to the baselines of the same corpus size.
+    Returns a list of (case, measurement, baseline, result) regressions,
+    where the result is more than the tolerance worse than the baseline"""
+    regressions = []
+    for case, result in sorted(results.items()):
+        baseline = baselines.get(case)
+        if baseline is None:
+            continue
+        for measurement in ("seconds", "peak_mb"):
+            old, new = baseline.get(measurement), result.get(measurement)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + tolerance):
+                regressions.append((case, measurement, old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+    # Run a single case: harness.py <case> <json corpus paths> <workdir>
+    measurements = run_case_here(sys.argv[1], json.loads(sys.argv[2]),
+                                 sys.argv[3])
+    print(json.dumps(measurements))
@@ -0,0 +1,154 @@
+# encoding: utf-8
+"""
+A catalog of the metadata of a library of ePubs in an SQLite file. Only the
+zip directory, the container and the package (.opf) file of every book are
+read, and only for the books that were added or changed (by modification
+time and size) since the last update, in a pool of processes
+"""
+import os
+import json
+import time
+import sqlite3
+import zipfile
+import xml.etree.ElementTree as ET
+
+from reader import read_metadata, read_package_path, update_books
+
+
+CATALOG_FILENAME = ".epub-catalog.sqlite"
+CATALOG_VERSION = 1  # Catalogs of other versions are built again
+COMMIT_EVERY = 1000  # Books stored per transaction
+
+# The metadata of a book that is stored, besides its tags
+FIELDS = ("title", "author", "series", "volume", "language", "description")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT,
+    author TEXT,
+    series TEXT,
+    volume TEXT,
+    language TEXT,
+    description TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+    book_id INTEGER NOT NULL,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_book ON tags (book_id);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag);
+"""
+
+
+def read_book_metadata(path):
+    """Reads the metadata of the ePub at the given path from its package
+    file, like reader.read_metadata. Returns (metadata, None), or
+    (None, the error) if the ePub cannot be read"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            package_root = ET.fromstring(
+                archive.read(read_package_path(archive)))
+        return (read_metadata(package_root), None)
+    except Exception as e:
+        return (None, "{}: {}".format(type(e).__name__, e))
+
+
+class Catalog:
+    """The metadata catalog of the ePubs in a folder, stored in a file in
+    the folder (or at the given path)"""
+    def __init__(self, folder, path=None):
+        self.folder = folder
+        self.path = path or os.path.join(folder, CATALOG_FILENAME)
+        self.db = sqlite3.connect(self.path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != CATALOG_VERSION:
+            self.db.executescript(
+                "DROP TABLE IF EXISTS tags; DROP TABLE IF EXISTS books;")
+            self.db.execute("PRAGMA user_version = {}".format(CATALOG_VERSION))
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def remove_books(self, book_ids):
+        """Removes the books with the given ids from the catalog"""
+        rows = [(book_id,) for book_id in book_ids]
+        self.db.executemany("DELETE FROM tags WHERE book_id = ?", rows)
+        self.db.executemany("DELETE FROM books WHERE id = ?", rows)
+
+    def add_book(self, path, stat, metadata, error=None):
+        """Adds the metadata of a book (or the error reading it, so that it
+        is only read again once it changes) to the catalog"""
+        metadata = metadata or {}
+        book_id = self.db.execute(
+            "INSERT INTO books (path, mtime_ns, size, {}, error) "
+            "VALUES (?, ?, ?, {}?)".format(
+                ", ".join(FIELDS), "?, " * len(FIELDS)),
+            (path, stat.st_mtime_ns, stat.st_size) +
+            tuple(metadata.get(field) for field in FIELDS) +
+            (error,)).lastrowid
+        self.db.executemany(
+            "INSERT INTO tags (book_id, tag) VALUES (?, ?)",
+            [(book_id, tag) for tag in metadata.get("tags", [])])
+
+    def update(self, workers=1):
+        """Reads the metadata of the ePubs in the folder that are new or
+        changed since the last update, and forgets the ones that are gone,
+        with the given number of processes (0 uses every CPU core).
+        Returns the number of (read, unchanged, removed) books"""
+        start = time.perf_counter()
+        read, unchanged, removed = update_books(
+            self.db, self.folder, read_book_metadata, self.add_book,
+            self.remove_books, workers, commit_every=COMMIT_EVERY)
+        print("Cataloged {} books ({} unchanged, {} removed) in {:.1f}s".format(
+            read, unchanged, removed, time.perf_counter() - start))
+        return (read, unchanged, removed)
+
+    def books(self):
+        """Returns the metadata of the cataloged books, ordered by author,
+        series, volume and title, as dictionaries like the metadata of a
+        specification with the path of the book"""
+        tags = {}
+        for book_id, tag in self.db.execute(
+                "SELECT book_id, tag FROM tags ORDER BY rowid"):
+            tags.setdefault(book_id, []).append(tag)
+        books = []
+        for row in self.db.execute(
+                "SELECT id, path, {} FROM books WHERE error IS NULL "
+                "ORDER BY author, series, volume, title".format(
+                    ", ".join(FIELDS))):
+            book = {"path": row[1], "tags": tags.get(row[0], [])}
+            for field, value in zip(FIELDS, row[2:]):
+                if value is not None:
+                    book[field] = value
+            books.append(book)
+        return books
+
+    def to_json(self):
+        return json.dumps(self.books(), indent=2)
+
+    def report(self):
+        """Returns a line for every cataloged book"""
+        lines = []
+        for book in self.books():
+            line = "- {} by {}".format(
+                book.get("title", ""), book.get("author", ""))
+            if "series" in book:
+                line += " [{}]".format(" ".join(
+                    part for part in (book["series"], book.get("volume"))
+                    if part))
+            if book["tags"]:
+                line += " ({})".format(", ".join(book["tags"]))
+            lines.append("{}: {}".format(line, book["path"]))
+        return "\n".join(lines)
@@ -0,0 +1,168 @@
+# encoding: utf-8
+"""
+Decoding of source files that are not utf-8: their encoding is either given
+in the specification or detected from (at most) the first bytes of the file,
+and the detected encodings can be cached by the hash of the file contents
+"""
+import os
+import codecs
+import hashlib
+
+from jsoncache import JsonCache
+
+
+ENCODING_CACHE_FILENAME = ".epub-encodings.json"
+DETECT_CHUNK_SIZE = 64 * 1024
+DEFAULT_DETECT_LIMIT = 1024 * 1024  # Bytes fed to the detector at most
+
+
+def detect_encoding(source, limit=DEFAULT_DETECT_LIMIT):
+    """Detects the encoding of the given bytes by feeding them to a
+    universal detector a chunk at a time, until it is confident or the limit
+    of bytes is reached. Returns None if no encoding was detected"""
+    return detect_chunks(_chunks(source), limit)
+
+
+def detect_chunks(chunks, limit=DEFAULT_DETECT_LIMIT):
+    """Detects the encoding of the bytes given as an iterable of chunks, like
+    detect_encoding, so that they never need to be in memory together. A
+    limit of 0 or None feeds every chunk until the detector is confident"""
+    from chardet import UniversalDetector
+    detector = UniversalDetector()
+    fed = 0
+    for chunk in chunks:
+        if limit:
+            chunk = chunk[:limit - fed]
+            if not chunk:
+                break
+        detector.feed(chunk)
+        fed += len(chunk)
+        if detector.done:
+            break
+    detector.close()
+    return detector.result["encoding"]
+
+
+def _chunks(source):
+    for start in range(0, len(source), DETECT_CHUNK_SIZE):
+        yield source[start:start + DETECT_CHUNK_SIZE]
+
+
+def _file_chunks(path):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(DETECT_CHUNK_SIZE), b"")
+
+
+class EncodingCache(JsonCache):
+    """An on-disk cache of the detected encodings of source files in a
+    folder, so that repeated builds do not detect them again.
+    The entries are keyed by the hash of the contents of the files"""
+    def __init__(self, folder, filename=ENCODING_CACHE_FILENAME):
+        # content hash -> encoding
+        super().__init__(os.path.join(folder, filename), "encoding cache")
+
+    def detect(self, source, limit=DEFAULT_DETECT_LIMIT):
+        """Returns the encoding of the given bytes, detecting it only if
+        the same bytes were not seen before"""
+        return self.detect_with_key(
+            hashlib.sha1(source).hexdigest(), _chunks(source), limit)
+
+    def detect_with_key(self, key, chunks, limit=DEFAULT_DETECT_LIMIT):
+        """Like detect, where the key is the hash of the whole file and its
+        bytes are given as an iterable of chunks, which is only read if the
+        encoding is not cached"""
+        encoding = self.entries.get(key)
+        if encoding is None:
+            encoding = detect_chunks(chunks, limit)
+            if encoding is not None:
+                self.entries[key] = encoding
+                self.changed = True
+        return encoding
+
+
+class SourceDecoder:
+    """Decodes the source files of a book: the encodings are a dictionary
+    of source path -> the encoding of the file (like the [source_encodings]
+    of a specification), and the encodings of the other files are detected
+    from at most the limit of bytes (0 or None for no limit), through the
+    EncodingCache if any"""
+    def __init__(self, encodings=None, cache=None, limit=DEFAULT_DETECT_LIMIT):
+        self.encodings = {
+            os.path.abspath(path): encoding
+            for path, encoding in (encodings or {}).items()}
+        self.cache = cache
+        self.limit = limit
+
+    def decode(self, path, source):
+        """Decodes the bytes of the source file at the given path"""
+        return decode_source(
+            source, self.encodings.get(os.path.abspath(path)), self.cache,
+            self.limit, name=path)
+
+    def stream_encoding(self, path):
+        """Returns the encoding to read the source file at the given path
+        with as a stream: the given encoding, or utf-8 if the whole file is
+        valid utf-8, or else the detected encoding. The file is checked (and
+        read again to detect its encoding, unless it is cached) a chunk at a
+        time, so it is never loaded as a whole"""
+        encoding = self.encodings.get(os.path.abspath(path))
+        if encoding is not None:
+            return encoding
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        valid = True
+        digest = hashlib.sha1()
+        for chunk in _file_chunks(path):
+            # Hash it all, so that the cache key is the same as in decode
+            digest.update(chunk)
+            if valid:
+                try:
+                    utf8.decode(chunk)
+                except UnicodeDecodeError:
+                    valid = False
+        if valid:
+            try:
+                utf8.decode(b"", final=True)
+                return "utf-8"
+            except UnicodeDecodeError:
+                pass
+
+        # Detected from the file read again a chunk at a time, if not cached
+        if self.cache is not None:
+            encoding = self.cache.detect_with_key(
+                digest.hexdigest(), _file_chunks(path), self.limit)
+        else:
+            encoding = detect_chunks(_file_chunks(path), self.limit)
+        if encoding is None:
+            raise Exception(
+                "Could not detect the encoding of {!r}, please give it in the "
+                "[source_encodings] of the specification".format(path))
+        return encoding
+
+
+def decode_source(source, encoding=None, cache=None, limit=DEFAULT_DETECT_LIMIT,
+                  name="source"):
+    """Decodes the bytes of a source file with the given encoding, or else as
+    utf-8 if possible, or else with an encoding detected from at most the
+    limit of bytes (through the EncodingCache, if any)"""
+    if encoding is not None:
+        return str(source, encoding=encoding)
+    try:
+        return str(source, encoding="utf-8")
+    except UnicodeDecodeError:
+        pass
+
+    if cache is not None:
+        encoding = cache.detect(source, limit)
+    else:
+        encoding = detect_encoding(source, limit)
+    if encoding is None:
+        raise Exception(
+            "Could not detect the encoding of {!r}, please give it in the "
+            "[source_encodings] of the specification".format(name))
+    try:
+        return str(source, encoding=encoding)
+    except UnicodeDecodeError:
+        raise Exception(
+            "The encoding of {!r} was detected as {!r}, which does not fit "
+            "the whole file. Please give it in the [source_encodings] of the "
+            "specification".format(name, encoding))
@@ -5,13 +5,13 @@ Library and command-line for the creation of ePub books from a set of images,
 eg. loaded from a folder
 """
 import os
-import sys
-import argparse
 import tempfile
-from PIL import Image
 
 from compile import compile_epub
-import toml
+from templating import get_template
+from imageinfo import probe_image, ProbeCache
+from optimize import optimize_images, report_reduction
+from stats import Stats
 
 
 def get_local(*path):
@@ -29,72 +29,139 @@ DEFAULT_AUTHOR = os.environ.get("USER", "Unknown author")
 
 def get_image_size(imagepath):
     """Returns the size of the given image"""
-    img = Image.open(imagepath)
-    return img.size
+    info = probe_image(imagepath)
+    return (info.width, info.height)
 
 
-def compile_epub_from_images(title, author, path, *image_paths):
-    """Creates an ePub from the given list of image files"""
-    if not image_paths:
-        raise Exception("No images provided!")
+def probe_pages(image_paths, probe_cache=None, stats=None):
+    """Probes the size of every image once, through the given
+    imageinfo.ProbeCache if any. Returns a list of (path, ImageInfo,
+    filename in the ePub) pages, without the images that cannot be read"""
+    probe = probe_cache.probe if probe_cache is not None else probe_image
+    if stats is None:
+        stats = Stats()
+    pages = []
+    for image_path in image_paths:
+        try:
+            with stats.timer("probe", image_path):
+                pages.append((
+                    image_path, probe(image_path),
+                    os.path.basename(image_path)))
+        except OSError:
+            print("Error reading image: {!r}".format(image_path))
+    if probe_cache is not None:
+        probe_cache.save()
+    return pages
+
+
+def optimize_pages(image_paths, profile, directory, workers=1, stats=None):
+    """Optimizes the images for the named device profile into the given
+    directory (see optimize.py). Returns a list of (path, ImageInfo,
+    filename in the ePub) pages of the optimized images, which are named
+    after the original images, unless another page has that name already.
+    Images that cannot be optimized are used as they are, and the ones that
+    cannot be read are left out"""
+    if stats is None:
+        stats = Stats()
+    results = optimize_images(image_paths, profile, directory, workers)
+    pages = []
+    for image_path, result in zip(image_paths, results):
+        if result is None:
+            pages.extend(probe_pages([image_path], stats=stats))
+            continue
+        stats.record(
+            "optimize", result.seconds, result.size_in, result.size_out,
+            name=image_path)
+        filename = os.path.basename(image_path)
+        if result.path != image_path:
+            filename = filename.rsplit(".", 1)[0] + ".jpg"
+        pages.append((result.path, result.info, filename))
+    # The unique name of the optimized file only for clashing names
+    used = set()
+    for num, (page_path, info, filename) in enumerate(pages):
+        if filename in used:
+            filename = os.path.basename(page_path)
+            pages[num] = (page_path, info, filename)
+        used.add(filename)
+    print(report_reduction(results, profile))
+    return pages
+
+
+def compile_epub_from_pages(title, author, path, pages, stats=None):
+    """Creates an ePub with a page for each of the given (path, ImageInfo,
+    filename in the ePub) images"""
+    if not pages:
+        raise Exception("None of the images could be read!")
     
     if author is None:
         author = DEFAULT_AUTHOR
     
-    with open(IMAGE_PAGE_TEMPLATE_FILE) as f:
-        chapter_template = f.read()
-    
+    chapter_template = get_template(IMAGE_PAGE_TEMPLATE_FILE)
     
     def iter_images():
-        """Iterates over the images and returns their name and bytes"""
-        for image_path in image_paths:
-            filename = os.path.basename(image_path)
+        """Iterates over the images and returns their name and path"""
+        for image_path, _, filename in pages:
             name = filename.rsplit(".", 1)[0]
-            with open(image_path, "rb") as f:
-                contents = f.read()
-            yield (name, filename, contents)
-        raise StopIteration
+            yield (name, filename, image_path)
     
     
     def iter_chapters():
         """Iterates over the images and creates chapters pointing to the images"""
-        for image_path in image_paths:
-            filename = os.path.basename(image_path)
+        for _, info, filename in pages:
             title = "page_" + filename.rsplit(".", 1)[0]
             chapter_file = title + ".html"
-            try:
-                width, height = get_image_size(image_path)
-            except OSError:
-                print("Error reading image: {!r}".format(image_path))
-                continue
             text = chapter_template.format_map({
                 "title": title,
                 "filename": filename,
-                "width": width,
-                "height": height,
+                "width": info.width,
+                "height": info.height,
             })
             # print("Chapter: {!r} | {!r}".format(title, chapter_file))
             yield (title, chapter_file, text)
-        
-        raise StopIteration
     
     
-    cover_path = image_paths[0]
+    cover_path = pages[0][0]
     cover_type = cover_path.rsplit(".")[-1]
-    with open(cover_path, "rb") as f:
-        cover_bytes = f.read()
-        
+
     metadata = {
         "tags": ["Image compilation"]
     }
 
     compile_epub(
-        title, author, cover_type, cover_bytes, iter_chapters(), 
-        images=iter_images(), path=path, metadata=metadata)
+        title, author, cover_type, cover_path, iter_chapters(), 
+        images=iter_images(), path=path, metadata=metadata, stats=stats)
+
+
+def compile_epub_from_images(
+        title, author, path, *image_paths, probe_cache=None, profile=None,
+        workers=1, stats=None):
+    """Creates an ePub from the given list of image files.
+    The sizes of the images are read from their headers, through the given
+    imageinfo.ProbeCache if any. Images that cannot be read are skipped.
+    With the name of a device profile (see optimize.DEVICE_PROFILES), the
+    images are optimized for the device in the given number of processes.
+    The timings are recorded in the given stats.Stats"""
+    if not image_paths:
+        raise Exception("No images provided!")
+    
+    if profile is None:
+        pages = probe_pages(image_paths, probe_cache, stats)
+        compile_epub_from_pages(title, author, path, pages, stats)
+    else:
+        # The optimized images are streamed into the ePub from here
+        with tempfile.TemporaryDirectory(prefix="epub-pages-") as directory:
+            pages = optimize_pages(
+                image_paths, profile, directory, workers, stats)
+            compile_epub_from_pages(title, author, path, pages, stats)
 
 
-def compile_epub_from_folder(folder, title=None, author=None, path=None):
-    """Creates an ePub from the image files contained in the given folder"""
+def compile_epub_from_folder(
+        folder, title=None, author=None, path=None, probe_cache=False,
+        profile=None, workers=1, stats=None):
+    """Creates an ePub from the image files contained in the given folder.
+    With probe_cache, the image sizes are cached in a file in the folder,
+    so that rebuilding from the same images does not read them again.
+    With a device profile, the images are optimized for the device"""
     endings = (".png", ".jpg", ".jpeg", ".svg", ".bmp", ".gif")
     def is_image(name):
         return (not name.startswith(".")) and name.lower().endswith(endings)
@@ -110,4 +177,7 @@ def compile_epub_from_folder(folder, title=None, author=None, path=None):
     files = [os.path.join(folder, x) for x in os.listdir(folder) if is_image(x)]
     images = sorted(files, key=key)
     title = title if title else os.path.basename(folder)
-    compile_epub_from_images(title, author, path, *images)
+    cache = ProbeCache(folder) if probe_cache else None
+    compile_epub_from_images(
+        title, author, path, *images, probe_cache=cache, profile=profile,
+        workers=workers, stats=stats)
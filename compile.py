@@ -5,12 +5,26 @@ Helps with the compilation of an e-book based on a lightly markupped plaintext f
 and a small specification file.
 """
 import os
+import io
 import re
-
-import markdown
-import chardet
+import sys
+import copy
+import time
+import threading
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, Future
+
+# markdown is imported where it is needed, since importing it is slow
 from spec_validator import validate_spec
+from templating import get_template
+from incremental import IncrementalBuild, text_digest
+from writer import RawEntry, CompressionPolicy
 from epub import Epub
+from stats import Stats, call_with_stats
+from pipeline import prefetch_images, prefetch_chapters
+from pipeline import DEFAULT_THREADS, DEFAULT_BUDGET
+from charset import SourceDecoder, EncodingCache, DEFAULT_DETECT_LIMIT
 
 
 def get_local(*path):
@@ -26,30 +40,76 @@ def template(*path):
 MARKDOWN_TEMPLATE_FILE = template("markdown.tpl")
 
 
-def compile_epub(title, author, cover_type, cover_bytes, chapters, images=[], path=None, metadata={}):
+def compile_epub(
+        title, author, cover_type, cover, chapters, images=[], 
+        path=None, metadata={}, compression=None, stats=None,
+        prefetch_threads=DEFAULT_THREADS, prefetch_budget=DEFAULT_BUDGET):
     """Compiles an ePub from the given arguments.
     The path is where the ePub should be saved to 
-    (or with a default name in the current direcory).
+    (or with a default name in the current direcory). It may also be a
+    writable binary stream, which need not be seekable (like a socket or
+    stdout): the entries are written to it as they are added.
+    The cover is either the bytes of the cover image or the path to it.
     The chapters should be an iterable of (title, filename, chapter_text) pairs.
-    The images should be an iterable of (title, filename, bytes) pairs
-    pairs"""
+    The images should be an iterable of (title, filename, image) pairs,
+    where the image is either its bytes or the path to the image file. 
+    Images given as paths are streamed into the ePub. Chapters and images
+    may also be RawEntry objects to copy from another ePub.
+    The images are added before the chapters, so that the references to
+    duplicate images in the chapters can be rewritten to the stored ones.
+    The compression is a writer.CompressionPolicy, a compression level or
+    a dictionary like the 'compression' table of a specification.
+    The stats is the stats.Stats that the timings are recorded in.
+    While the archive is written, the next image files are read ahead on
+    the given number of threads, and the next chapters are prepared on a
+    background thread, with at most the budget of bytes loaded ahead of
+    each (see pipeline.py). No threads reads everything in turn"""
     if not path:
         path = title + " - " + author + ".epub"
 
-    print("Compiling epub...")
+    print("Compiling epub...", file=sys.stderr)
     with Epub(
-            title, author, path, cover_type, cover_bytes, 
-            metadata=metadata) as epub:
+            title, author, path, cover_type, metadata=metadata,
+            compression=compression, stats=stats) as epub:
         
-        epub.add_cover(cover_type, cover_bytes)
+        if isinstance(cover, bytes):
+            epub.add_cover(cover_type, cover)
+        else:
+            epub.add_cover_from_path(cover_type, cover)
+
+        images = prefetch_images(
+            images, prefetch_threads, prefetch_budget, stats)
+        for (local_name, filename, image, digest) in images:
+            if isinstance(image, (bytes, RawEntry)):
+                epub.add_image(local_name, filename, image, digest)
+            else:
+                epub.add_image_from_path(local_name, filename, image)
+
+        # Only started now, as the chapters depend on the images added
+        chapters = prefetch_chapters(
+            chapters, prefetch_threads, prefetch_budget)
         for (local_name, filename, text) in chapters:
             epub.add_chapter(local_name, filename, text)
-            
-        for (local_name, filename, image_bytes) in images:
-            epub.add_image(local_name, filename, image_bytes)
 
-    print("Done!")
-    print("Saved ePub to {!r}".format(path))
+    # Never to stdout, which may be the stream the ePub is written to
+    print("Done!", file=sys.stderr)
+    if not is_stream(path):
+        print("Saved ePub to {!r}".format(path), file=sys.stderr)
+
+
+def compile_epub_to_bytes(
+        title, author, cover_type, cover, chapters, images=[], **kwargs):
+    """Compiles an ePub like compile_epub, in memory, and returns its bytes"""
+    buffer = io.BytesIO()
+    compile_epub(
+        title, author, cover_type, cover, chapters, images, path=buffer,
+        **kwargs)
+    return buffer.getvalue()
+
+
+def is_stream(target):
+    """Returns whether the target of an ePub is a stream and not a path"""
+    return hasattr(target, "write")
     
 
 def get_local(*path):
@@ -73,85 +133,310 @@ def clean_html(html):
     return _pattern.sub(_replacer, html)
 
 
-def split_and_compile(source_text):
-    """Splits the source text into chapters and compiles each to html from
-    markdown. Returns a list of (filename, content), and the list of these
-    filenames"""
-    # All this splitting makes it slow :c
+# Engines for compiling markdown chapters
+MARKDOWN_ENGINES = ("chapter", "line")
+EMPTY_PARAGRAPH = "<p></p>"
+
+# Lines that continue a list, which must not be split into separate blocks
+_list_item_pattern = re.compile(r" {0,3}([*+-]|\d+\.)\s")
+
+
+def compile_lines(lines):
+    """Compiles each line of a chapter by itself (the old, slow engine)"""
+    import markdown
+    compiled = []
+    for line in lines:
+        if not line:
+            # Preserve the space
+            compiled.append(EMPTY_PARAGRAPH)
+        else:
+            # Get the markdown for this line
+            compiled.append(markdown.markdown(line))
+    return "\n".join(compiled)
+
+
+def compile_chapter(lines, converter):
+    """Compiles the lines of a chapter in a single pass with the given
+    markdown converter. Every line is kept as its own block like in the line
+    engine, except for list items, which are joined to a single list"""
+    blocks = []
+    in_list = False
+    for line in lines:
+        if not line:
+            # Preserve the space as a raw html block
+            blocks.append("\n\n" + EMPTY_PARAGRAPH)
+            in_list = False
+        elif in_list and _list_item_pattern.match(line):
+            blocks.append("\n" + line)
+        else:
+            blocks.append("\n\n" + line)
+            in_list = _list_item_pattern.match(line) is not None
+    converter.reset()
+    return converter.convert("".join(blocks))
+
+
+def split_chapters(source_text):
+    """Splits the markdown source text into chapters.
+    Yields (chapter_name, filename, lines) tuples"""
     after_first_chapter = False
-    for num, text in enumerate(source_text.split("\n# "), 1):
+    for text in source_text.split("\n# "):
         # Use the first line (minus the markdown header marker) as the title
         start = 2 if text.startswith("# ") else 0
         chapter_name = text[start : text.find("\n")]
         name = "{}.html".format(chapter_name)
-        lines = []
-
-        line_started = False
-        for line in text.split("\n"):
-            # Add the header sign (#) that was removed by the splitting
-            if after_first_chapter and not line_started:
-                line = "# " + line
 
-            if not line:
-                # Preserve the space
-                lines.append("<p></p>")
-
-            else:
-                # Get the markdown for this line
-                lines.append(markdown.markdown(line))
-            line_started = True
+        lines = text.split("\n")
+        # Add the header sign (#) that was removed by the splitting
+        if after_first_chapter:
+            lines[0] = "# " + lines[0]
 
-        template = quick_load(MARKDOWN_TEMPLATE_FILE)
-        html = template.format_map({"text": "\n".join(lines)})
-        yield (chapter_name, name, html)
+        yield (chapter_name, name, lines)
         after_first_chapter = True
 
-    raise StopIteration
 
+def stream_chapters(path, stats=None, decoder=None):
+    """Reads the markdown source at the given path a line at a time, and
+    yields its chapters like split_chapters as soon as the next chapter
+    starts, so that only one chapter is in memory at a time"""
+    if stats is None:
+        stats = Stats()
+    if decoder is None:
+        decoder = SourceDecoder()
+    with stats.timer("decode", path, bytes_in=os.path.getsize(path)):
+        encoding = decoder.stream_encoding(path)
+
+    def chapter(lines, start, size):
+        # Name it like split_chapters, by the first line minus the marker
+        first = lines[0]
+        chapter_name = first[2:] if first.startswith("# ") else first
+        stats.record("load", time.perf_counter() - start, size, size,
+                     name=chapter_name)
+        return (chapter_name, "{}.html".format(chapter_name), lines)
+
+    lines = []
+    size = 0
+    ended_line = False
+    start = time.perf_counter()
+    # Keep the line endings as they are, like splitting the whole text does
+    with open(path, encoding=encoding, newline="") as f:
+        for line in f:
+            if line.startswith("# ") and lines:
+                yield chapter(lines, start, size)
+                lines = []
+                size = 0
+                start = time.perf_counter()
+            size += len(line)
+            ended_line = line.endswith("\n")
+            lines.append(line[:-1] if ended_line else line)
+    if lines:
+        if ended_line:
+            # The text after the last line break is an empty line
+            lines.append("")
+        yield chapter(lines, start, size)
+
+
+# The converters are not thread-safe, and chapters may be compiled on
+# several threads (like the prefetching one), so every thread has its own
+_converters = threading.local()
+def get_converter():
+    """Returns the markdown converter of this thread, which is reused (and
+    reset) for every chapter"""
+    converter = getattr(_converters, "converter", None)
+    if converter is None:
+        import markdown
+        converter = _converters.converter = markdown.Markdown()
+    return converter
+
+
+def compile_markdown(
+        chapter_name, name, lines, engine="chapter", stats=None):
+    """Compiles the lines of a markdown chapter to a html page.
+    The engine is either 'chapter', which compiles the chapter in one go
+    with a reused converter, or 'line', which compiles every line by itself.
+    Returns a (chapter_name, filename, html) tuple"""
+    if stats is None:
+        stats = Stats()
+    with stats.timer("markdown", name) as timer:
+        timer.bytes_in = sum(len(line) + 1 for line in lines)
+        if engine == "chapter":
+            body = compile_chapter(lines, get_converter())
+        elif engine == "line":
+            body = compile_lines(lines)
+        else:
+            raise Exception("Unknown markdown engine: {!r}".format(engine))
 
-def load_source_text(path):
-    """Loads the text in the given source as utf-8"""
-    with open(path, "rb") as f:
-        source = f.read()
-    try:
-        return str(source, encoding="utf-8")
-    except UnicodeDecodeError:
-        encoding = chardet.detect(source)["encoding"]
-        return str(source, encoding=encoding)
-
+        template = get_template(MARKDOWN_TEMPLATE_FILE)
+        html = template.format_map({"text": body})
+        timer.bytes_out = len(html)
+    return (chapter_name, name, html)
 
-def iter_load_chapters(directory, source_paths):
-    """Yields the chapter tuples from loading the given text source paths.
-    source_is_html toggles whether to interpret the text contents as html 
-    or compile from them as markdown"""
-    for path in (os.path.join(directory, p) for p in source_paths):
-        source_text = load_source_text(path)
-        base = os.path.basename(path)
-        name = base.rsplit(".", 1)[0]
-        if path.endswith((".html", ".xhtml")):
-            text = clean_html(source_text)
-            yield (name, base, text)
-        elif path.endswith(".md"):
-            yield from split_and_compile(source_text)
-        else:
-            yield (name, base, source_text)
 
-    raise StopIteration
+def split_and_compile(source_text, engine="chapter"):
+    """Splits the source text into chapters and compiles each to html from
+    markdown. Yields (chapter_name, filename, html) tuples"""
+    for chapter_name, name, lines in split_chapters(source_text):
+        yield compile_markdown(chapter_name, name, lines, engine=engine)
+
+
+def load_source_text(path, stats=None, decoder=None):
+    """Loads the text in the given source as utf-8, or with the encoding
+    given or detected by the charset.SourceDecoder"""
+    if stats is None:
+        stats = Stats()
+    if decoder is None:
+        decoder = SourceDecoder()
+    with stats.timer("load", path) as timer:
+        with open(path, "rb") as f:
+            source = f.read()
+        timer.bytes_in = timer.bytes_out = len(source)
+    with stats.timer("decode", path, bytes_in=len(source)) as timer:
+        text = decoder.decode(path, source)
+        timer.bytes_out = len(text)
+    return text
 
 
-def iter_load_images(directory, images, image_folders=[]):
-    """Loads and iterates over the images from the images and image folders 
-    parts of the ePub specification file"""
+def load_chapter(path, stats=None, decoder=None):
+    """Loads a html or plaintext source file as a single chapter.
+    Returns a (chapter_name, filename, text) tuple"""
+    source_text = load_source_text(path, stats, decoder)
+    base = os.path.basename(path)
+    name = base.rsplit(".", 1)[0]
+    if path.endswith((".html", ".xhtml")):
+        return (name, base, clean_html(source_text))
+    else:
+        return (name, base, source_text)
+
+
+def iter_chapter_tasks(
+        source_paths, markdown_engine="chapter", build=None, stats=None,
+        decoder=None, stream=False):
+    """Yields a (function, args) task for every chapter of the given
+    sources in spine order. Calling a function with its args (and a stats
+    keyword) returns the chapter tuple. Markdown sources are loaded and
+    split right away, so that every chapter becomes a task of its own (with
+    stream, they are read and split a line at a time as the tasks are run).
+    Other sources only need loading, which is done right away as well, so
+    that their detected encodings end up in the cache of the decoder.
+    These and the unchanged chapters of an incremental.IncrementalBuild are
+    yielded as (None, chapter) tuples (with a RawEntry as the text of the
+    unchanged chapters). The images must have been recorded in the build
+    before the first task is asked for, as the chapters depend on which of
+    them are duplicates"""
+    aliases = build.alias_signature() if build is not None else ""
+    for path in source_paths:
+        if path.endswith(".md"):
+            if stream:
+                chapters = stream_chapters(path, stats, decoder)
+            else:
+                source_text = load_source_text(path, stats, decoder)
+                chapters = split_chapters(source_text)
+            if build is not None:
+                template = get_template(MARKDOWN_TEMPLATE_FILE)
+                settings = [markdown_engine, template.text]
+                if aliases:
+                    settings.append(aliases)
+            for chapter_name, name, lines in chapters:
+                if build is not None:
+                    digest = text_digest(*settings, "\n".join(lines))
+                    raw = build.reuse(name, digest)
+                    if raw is not None:
+                        yield (None, (chapter_name, name, raw))
+                        continue
+                args = (chapter_name, name, lines, markdown_engine)
+                yield (compile_markdown, args)
+        else:
+            if build is not None:
+                base = os.path.basename(path)
+                digest = build.file_digest(path)
+                if aliases:
+                    digest = text_digest(digest, aliases)
+                raw = build.reuse(base, digest)
+                if raw is not None:
+                    yield (None, (base.rsplit(".", 1)[0], base, raw))
+                    continue
+            yield (None, load_chapter(path, stats, decoder))
+
+
+def run_tasks(tasks, workers=1, max_in_flight=None, stats=None):
+    """Runs the (function, args) tasks and yields their results in order.
+    Tasks without a function have their result as the args.
+    With more than one worker, the tasks are run in a process pool with at
+    most max_in_flight (default: twice the workers) submitted at a time.
+    The functions record their timings in the given stats"""
+    if stats is None:
+        stats = Stats()
+    if workers == 1:
+        for func, args in tasks:
+            yield func(*args, stats=stats) if func is not None else args
+        return
+
+    def result(future):
+        # The workers return their own stats along with the result
+        value, worker_stats = future.result()
+        stats.merge(worker_stats)
+        return value
+
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for func, args in tasks:
+            if func is None:
+                future = Future()
+                future.set_result((args, Stats()))
+            else:
+                future = pool.submit(
+                    call_with_stats, func, args, stats.keep_entries)
+            pending.append(future)
+            if len(pending) >= max_in_flight:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+
+
+def get_workers(workers):
+    """Returns the number of worker processes to use, where 0 means one for
+    every CPU core"""
+    if not workers:
+        return os.cpu_count() or 1
+    return workers
+
+
+def iter_load_chapters(
+        directory, source_paths, markdown_engine="chapter", workers=1,
+        build=None, stats=None, decoder=None, stream=False):
+    """Yields the chapter tuples from loading the given text source paths.
+    Html sources are cleaned, markdown sources are compiled and anything else
+    is used as it is. With more than one worker, the chapters are compiled
+    in parallel, but still yielded in order. With an IncrementalBuild, the
+    unchanged chapters are copied from the previous build instead"""
+    paths = (os.path.join(directory, p) for p in source_paths)
+    tasks = iter_chapter_tasks(
+        paths, markdown_engine=markdown_engine, build=build, stats=stats,
+        decoder=decoder, stream=stream)
+    yield from run_tasks(tasks, workers=get_workers(workers), stats=stats)
+
+
+def iter_load_images(directory, images, image_folders=[], build=None):
+    """Iterates over the images from the images and image folders parts of
+    the ePub specification file. Yields (name, filename, path) tuples, so
+    that the images can be streamed from the disk. With an IncrementalBuild,
+    unchanged images are yielded as RawEntry objects instead of paths"""
     endings = (".png", ".jpg", ".jpeg", ".svg", ".bmp", ".gif")
     def is_image(name):
         return (not name.startswith(".")) and name.lower().endswith(endings)
     
+    def reuse(filename, path):
+        if build is not None:
+            raw = build.reuse(filename, build.file_digest(path))
+            if raw is not None:
+                return raw
+        return path
+    
     for name, relative_path in images.items():
         path = os.path.join(directory, relative_path)
         filename = os.path.basename(path)
-        with open(path, "rb") as f:
-            contents = f.read()
-        yield (name, filename, contents)
+        yield (name, filename, reuse(filename, path))
         
     for folder in (os.path.join(directory, f) for f in image_folders):
         for dirpath, _, filenames in os.walk(folder):
@@ -159,17 +444,31 @@ def iter_load_images(directory, images, image_folders=[]):
                 if filename not in images:
                     filepath = os.path.abspath(os.path.join(dirpath, filename))
                     name = filename.rsplit(".", 1)[0]
-                    with open(filepath, "rb") as f:
-                        contents = f.read()
-                    yield (name, filename, contents)
+                    yield (name, filename, reuse(filename, filepath))
                 else:
-                    print("! Duplicate image found: {!r}".format(filename))
-    
-    raise StopIteration
+                    print("! Duplicate image found: {!r}".format(filename),
+                          file=sys.stderr)
+
+
+def with_compression_threads(compression, threads):
+    """Returns the 'compression' value of a specification (or a
+    writer.CompressionPolicy) with the given number of deflate threads"""
+    if isinstance(compression, CompressionPolicy):
+        compression = copy.copy(compression)
+        compression.threads = threads
+        return compression
+    elif isinstance(compression, int):
+        return {"level": compression, "threads": threads}
+    return dict(compression or {}, threads=threads)
 
 
-def compile_epub_from_specification(spec_dict, directory, target_path=None):
+def compile_epub_from_specification(
+        spec_dict, directory, target_path=None, workers=None,
+        incremental=False, stats=None, compression_threads=None):
     """# Compiles an ebook in the ePub format from the given specification file
+    # and returns the path of the ePub. The timings of the compilation are
+    # recorded in the given stats.Stats. The compression threads override
+    # the 'threads' of the compression table
     # =============================================================
     # Example of a specification file for a book in the ePub format
     # =============================================================
@@ -182,6 +481,12 @@ def compile_epub_from_specification(spec_dict, directory, target_path=None):
     source_files = ["test_source.md", "test_image_page.html"]
 
     # Optional
+    markdown_engine = "chapter" # or "line" to compile every line by itself
+    encoding_detection_limit = 1048576 # Bytes read to detect encodings
+    stream_sources = false # Read markdown a chapter at a time (less memory)
+    prefetch_threads = 4 # Threads reading ahead of the writer (0: none)
+    prefetch_budget = 16777216 # Bytes read ahead of the writer at most
+    workers     = 4 # Processes compiling chapters in parallel (0: all cores)
     language	= "en"
     series		= "Test series"
     volume		= 1
@@ -192,9 +497,21 @@ def compile_epub_from_specification(spec_dict, directory, target_path=None):
 
     [image_files]
     image1 = "test_cover.png"
+
+    # The encodings of sources that are not utf-8 (others are detected)
+    [source_encodings]
+    "old_chapter.html" = "cp1252"
+
+    # How entries are compressed (images are stored as they are by default)
+    [compression]
+    level = 9
+    store = [".jpg", ".jpeg", ".png", ".gif"]
+    threads = 4 # Threads deflating entries (0: all cores, 1: while writing)
     """
     # Ensure that this can be done!
     validate_spec(spec_dict, directory)
+    if workers is None:
+        workers = spec_dict.get("workers", 1)
 
     def get_local_to_spec(path):
         """Returns a path locally to the specfile"""
@@ -209,20 +526,62 @@ def compile_epub_from_specification(spec_dict, directory, target_path=None):
     # Cover
     cover_path = get_local_to_spec(spec_dict['cover_file'])
     cover_type = cover_path.rsplit(".", 1)[-1]
-    with open(cover_path, "rb") as f:
-        cover_bytes = f.read()
     
-    # Chapters
+    # Reuse the unchanged entries of the last build
+    build = None
+    if incremental and is_stream(target_path):
+        raise Exception(
+            "An incremental build needs the path of the last ePub, "
+            "not a stream")
+    if incremental:
+        compression = spec_dict.get("compression")
+        if isinstance(compression, dict):
+            # The threads do not change what is written
+            compression = {
+                key: value for key, value in compression.items()
+                if key != "threads"}
+        settings = {
+            "compression": compression,
+            "source_encodings": spec_dict.get("source_encodings"),
+        }
+        build = IncrementalBuild(target_path, settings=settings)
+        # The cover is always written again, but images may duplicate it
+        build.record("cover." + cover_type, build.file_digest(cover_path))
+    
+    # Chapters, with the detected encodings cached next to the spec
+    encoding_cache = EncodingCache(directory)
+    decoder = SourceDecoder(
+        {get_local_to_spec(f): encoding for f, encoding
+         in spec_dict.get("source_encodings", {}).items()},
+        cache=encoding_cache,
+        limit=spec_dict.get("encoding_detection_limit", DEFAULT_DETECT_LIMIT))
     files = (get_local_to_spec(f) for f in spec_dict['source_files'])
-    chapters = iter_load_chapters(directory, files)
+    chapters = iter_load_chapters(
+        directory, files,
+        markdown_engine=spec_dict.get("markdown_engine", "chapter"),
+        workers=workers, build=build, stats=stats, decoder=decoder,
+        stream=spec_dict.get("stream_sources", False))
     
     # Images
     images = iter_load_images(
         directory,
         spec_dict.get("image_files", {}), 
-        image_folders=spec_dict.get("image_folders", []))
+        image_folders=spec_dict.get("image_folders", []), build=build)
     
     
-    compile_epub(
-        title, author, cover_type, cover_bytes, chapters, images=images, 
-        path=target_path, metadata=spec_dict)
+    compression = spec_dict.get("compression")
+    if compression_threads is not None:
+        compression = with_compression_threads(compression, compression_threads)
+    
+    with build if build is not None else nullcontext():
+        compile_epub(
+            title, author, cover_type, cover_path, chapters, images=images, 
+            path=target_path, metadata=spec_dict,
+            compression=compression, stats=stats,
+            prefetch_threads=spec_dict.get("prefetch_threads", DEFAULT_THREADS),
+            prefetch_budget=spec_dict.get("prefetch_budget", DEFAULT_BUDGET))
+    encoding_cache.save()
+    if build is not None:
+        print("Reused {} unchanged entries".format(build.reused),
+              file=sys.stderr)
+    return target_path
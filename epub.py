@@ -1,43 +1,83 @@
 # encoding: utf-8
 # Created by Jabok @ Friday July 24th 2015
 """The main ePub class"""
-from writer import EpubWriter
-from decorators import not_implemented
+from writer import EpubWriter, ManifestItem
+from reader import EpubReader
 
 
 class Epub:
     """An EPub file"""
     def __init__(
             self, title, author, path, cover_type=None, cover_bytes=bytes(), 
-            chapters=[], images=[], metadata={}):
+            chapters=None, images=None, metadata=None, compression=None,
+            stats=None):
         """Creates a new ePub with the given parameters. Use 'load' for existing files."""
-        self.path = path
+        self.path = path # Or a writable binary stream to write the ePub to
         self.title = title
         self.author = author
-        self.chapters = chapters # [(local_id, file)]
-        self.images = images # [(local_id, file)]
+        # Every ePub has its own lists, which the writer adds to
+        self.chapters = list(chapters or []) # [ManifestItem] in spine order
+        self.images = list(images or []) # [ManifestItem]
         self.cover_bytes = cover_bytes
-        self.metadata = metadata
+        self.cover_path = None # Set when the cover is streamed from a file
+        self.metadata = metadata if metadata is not None else {}
+        self.compression = compression # See writer.CompressionPolicy
+        self.stats = stats # The stats.Stats of the writing, if any
+        self.reader = None # Set for loaded ePubs
         if cover_type:
             self.cover_file = "cover.{}".format(cover_type.replace(".", ""))
         else:
             self.cover_file = "ERROR: DEFAULT COVER NAME NOT CHANGED"
     
-    @not_implemented
-    def load(self, path):
-        """Loads an ePub from the file at the given path"""
+    @classmethod
+    def load(cls, path, cache_size=None):
+        """Loads an ePub from the file at the given path. Only the index of
+        the ePub is read, and chapters are read when they are asked for"""
+        if cache_size is None:
+            reader = EpubReader(path)
+        else:
+            reader = EpubReader(path, cache_size=cache_size)
+        def item(item_id):
+            member, media_type = reader.manifest[item_id]
+            try:
+                size = reader.file.getinfo(member).file_size
+            except KeyError:
+                size = 0
+            return ManifestItem(item_id, member, media_type, size)
+
+        chapters = [item(item_id) for item_id in reader.spine]
+        images = [
+            item(item_id)
+            for item_id, (_, media_type) in reader.manifest.items()
+            if media_type and media_type.startswith("image/")]
+        epub = cls(
+            reader.title, reader.author, path, chapters=chapters,
+            images=images, metadata=reader.metadata)
+        epub.reader = reader
+        return epub
 
     def __enter__(self):
+        # A loaded ePub is read, not written again: writing would truncate it
+        if self.reader is not None:
+            return self.reader
         self.writer = EpubWriter(self)
         return self.writer
     
     def __exit__(self, *args):
-        self.writer.close()
+        if self.reader is not None:
+            self.reader.close()
+        else:
+            self.writer.close()
     
-    @not_implemented
     def get_chapter(self, title):
-        """Prints the text of the given chapter"""
+        """Returns the text of the given chapter"""
+        return self.reader.get_chapter(title)
     
-    @not_implemented
     def print_text(self):
-        """Prints the text contents of the ePub"""
\ No newline at end of file
+        """Prints the text contents of the ePub"""
+        self.reader.print_text()
+
+    def close(self):
+        """Closes the file of a loaded ePub"""
+        if self.reader is not None:
+            self.reader.close()
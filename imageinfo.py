@@ -0,0 +1,169 @@
+# encoding: utf-8
+"""
+Reads the dimensions and format of images from their headers, without
+decoding any pixel data
+"""
+import os
+import io
+import struct
+from collections import namedtuple, OrderedDict
+
+from jsoncache import JsonCache
+
+
+ImageInfo = namedtuple("ImageInfo", ["width", "height", "format"])
+
+PROBE_CACHE_FILENAME = ".epub-probe.json"
+
+# JPEG markers that start a frame and carry the image size
+_jpeg_frame_markers = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG markers without a length
+_jpeg_standalone_markers = frozenset([0x01, 0xD8] + list(range(0xD0, 0xD8)))
+
+
+def _probe_jpeg(f):
+    """Finds the size in the frame header of the open JPEG file, which is
+    positioned right after the start-of-image marker"""
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":  # Fill bytes
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in _jpeg_standalone_markers:
+            continue
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0]
+        if marker in _jpeg_frame_markers:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack(">xHH", frame)
+            return ImageInfo(width, height, "jpeg")
+        f.seek(length - 2, io.SEEK_CUR)
+
+
+def probe_header(f):
+    """Reads the size and format of the image in the given open binary file
+    from its header. Returns None if the format is not recognized, or the
+    header is cut short"""
+    head = f.read(32)
+    if (head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR"
+            and len(head) >= 24):
+        width, height = struct.unpack(">II", head[16:24])
+        return ImageInfo(width, height, "png")
+
+    elif head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        width, height = struct.unpack("<HH", head[6:10])
+        return ImageInfo(width, height, "gif")
+
+    elif head.startswith(b"\xff\xd8"):
+        f.seek(2)
+        return _probe_jpeg(f)
+
+    elif head.startswith(b"BM") and len(head) >= 26:
+        width, height = struct.unpack("<ii", head[18:26])
+        return ImageInfo(width, abs(height), "bmp")
+
+    elif head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", head[26:30])
+            return ImageInfo(width & 0x3FFF, height & 0x3FFF, "webp")
+        elif chunk == b"VP8L":
+            bits = struct.unpack("<I", head[21:25])[0]
+            width = (bits & 0x3FFF) + 1
+            height = ((bits >> 14) & 0x3FFF) + 1
+            return ImageInfo(width, height, "webp")
+        elif chunk == b"VP8X":
+            width = int.from_bytes(head[24:27], "little") + 1
+            height = int.from_bytes(head[27:30], "little") + 1
+            return ImageInfo(width, height, "webp")
+
+    return None
+
+
+def _probe_with_pil(source):
+    """Falls back to PIL for the formats that are not parsed here. PIL only
+    reads the header until the pixels are needed"""
+    from PIL import Image
+    with Image.open(source) as image:
+        width, height = image.size
+        return ImageInfo(width, height, (image.format or "").lower())
+
+
+def probe_bytes(image_bytes):
+    """Returns the ImageInfo of the given image data"""
+    info = probe_header(io.BytesIO(image_bytes))
+    if info is None:
+        info = _probe_with_pil(io.BytesIO(image_bytes))
+    return info
+
+
+# The most recently probed images, bounded so that a long-running process
+# building many books does not keep growing
+PROBE_MEMO_SIZE = 64 * 1024
+_probed = OrderedDict()  # (path, mtime, size) -> ImageInfo
+
+
+def _probe_key(path, stat):
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def probe_image(path, stat=None):
+    """Returns the ImageInfo of the image file at the given path.
+    The results of the most recent probes are remembered by the process, so
+    every stage of a build can ask for them without reading the file again.
+    Raises an OSError if the image cannot be read"""
+    if stat is None:
+        stat = os.stat(path)
+    key = _probe_key(path, stat)
+    info = _probed.get(key)
+    if info is None:
+        with open(path, "rb") as f:
+            info = probe_header(f)
+        if info is None:
+            info = _probe_with_pil(path)
+        remember_probe(key, info)
+    else:
+        _probed.move_to_end(key)
+    return info
+
+
+def remember_probe(key, info):
+    """Adds a probe result to the memo of the process"""
+    _probed[key] = info
+    if len(_probed) > PROBE_MEMO_SIZE:
+        _probed.popitem(last=False)
+
+
+class ProbeCache(JsonCache):
+    """An on-disk cache of the image info of the files in a folder, so that
+    rebuilding from the same images does not need to read them again.
+    The entries are keyed by path, modification time and size"""
+    def __init__(self, folder, filename=PROBE_CACHE_FILENAME):
+        self.folder = folder
+        # relative path -> [mtime, size, width, height, format]
+        super().__init__(os.path.join(folder, filename), "probe cache")
+
+    def probe(self, path):
+        """Returns the ImageInfo of the image at the given path"""
+        stat = os.stat(path)
+        key = os.path.relpath(path, self.folder)
+        entry = self.entries.get(key)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            info = ImageInfo(*entry[2:])
+            remember_probe(_probe_key(path, stat), info)
+            return info
+        info = probe_image(path, stat)
+        self.entries[key] = [stat.st_mtime_ns, stat.st_size] + list(info)
+        self.changed = True
+        return info
@@ -0,0 +1,140 @@
+# encoding: utf-8
+"""
+Incremental rebuilds of ePubs: the content hash of every chapter and image
+is recorded in a manifest next to the ePub, and the entries whose hash did
+not change are copied (still compressed) from the previous ePub.
+"""
+import os
+import hashlib
+import zipfile
+
+from writer import RawEntry, hash_file
+from jsoncache import load_json, save_json
+
+
+BUILD_MANIFEST_SUFFIX = ".build.json"
+PREVIOUS_SUFFIX = ".previous"
+MANIFEST_VERSION = 1
+
+
+def text_digest(*parts):
+    """Returns the content hash of the given strings"""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class IncrementalBuild:
+    """The state of an incremental build of the ePub at the given path.
+    Use it as a context manager around the compilation: on entering, the
+    previous ePub is moved aside to copy from, and on a successful exit the
+    new manifest is saved (or the previous ePub is restored on failure).
+    Nothing is reused if the given settings differ from the last build"""
+    def __init__(self, path, settings=None):
+        self.path = path
+        self.settings = settings
+        self.manifest_path = path + BUILD_MANIFEST_SUFFIX
+        self.previous_path = path + PREVIOUS_SUFFIX
+        self.archive = None
+        self.entries = {}  # local file -> content hash (of the last build)
+        self.files = {}  # source path -> [mtime, size, content hash]
+        self.new_entries = {}
+        self.new_files = {}
+        self.reused = 0
+        self.load_manifest()
+
+    def load_manifest(self):
+        """Loads the manifest of the previous build, if it still matches the
+        ePub at the path"""
+        if not (os.path.exists(self.path) and
+                os.path.exists(self.manifest_path)):
+            return
+        manifest = load_json(self.manifest_path, "build manifest")
+        if manifest is None:
+            return
+        stat = os.stat(self.path)
+        if manifest.get("version") != MANIFEST_VERSION:
+            return
+        if manifest.get("settings") != self.settings:
+            return
+        # The ePub was written by something else since
+        if manifest.get("archive") != [stat.st_mtime_ns, stat.st_size]:
+            return
+        self.entries = manifest["entries"]
+        self.files = manifest["files"]
+
+    def __enter__(self):
+        if self.entries:
+            os.replace(self.path, self.previous_path)
+            self.archive = zipfile.ZipFile(self.previous_path)
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if self.archive is not None:
+            self.archive.close()
+            if exc_type is None:
+                os.remove(self.previous_path)
+            else:
+                os.replace(self.previous_path, self.path)
+        if exc_type is None:
+            self.save_manifest()
+
+    def save_manifest(self):
+        """Saves the hashes of this build next to the ePub"""
+        stat = os.stat(self.path)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "archive": [stat.st_mtime_ns, stat.st_size],
+            "settings": self.settings,
+            "entries": self.new_entries,
+            "files": self.new_files,
+        }
+        save_json(self.manifest_path, manifest)
+
+    def file_digest(self, path):
+        """Returns the content hash of the file at the given path. Files with
+        the same modification time and size as last time are not read"""
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.files.get(key)
+        if known and known[:2] == [stat.st_mtime_ns, stat.st_size]:
+            digest = known[2]
+        else:
+            digest = hash_file(path)
+        self.new_files[key] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def reuse(self, local_file, digest):
+        """Records the content hash of the given entry of the new ePub.
+        Returns a RawEntry to copy the entry from the previous ePub if its
+        hash is unchanged, or None if it must be compiled again"""
+        self.record(local_file, digest)
+        if self.archive is None or self.entries.get(local_file) != digest:
+            return None
+        try:
+            raw = RawEntry.from_archive(self.archive, local_file)
+        except KeyError:
+            return None
+        raw.digest = digest
+        self.reused += 1
+        return raw
+
+    def record(self, local_file, digest):
+        """Records the content hash of the given entry of the new ePub"""
+        self.new_entries[local_file] = digest
+
+    def alias_signature(self):
+        """Returns a hash of which of the entries recorded so far have the
+        same content as an earlier one, or '' if none do. The writer stores
+        such images once and rewrites the references to them, so a chapter
+        can only be reused while the aliases are the same"""
+        first = {}
+        aliases = []
+        for local_file, digest in self.new_entries.items():
+            if digest in first:
+                aliases.append("{}={}".format(local_file, first[digest]))
+            else:
+                first[digest] = local_file
+        return text_digest(*aliases) if aliases else ""
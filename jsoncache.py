@@ -0,0 +1,47 @@
+# encoding: utf-8
+"""
+JSON files that are kept next to the sources or the ePub between builds,
+like the caches of probed images and detected encodings. They are replaced
+atomically when saved, and ignored (to be rebuilt) when unreadable
+"""
+import os
+import json
+
+
+def load_json(path, name):
+    """Returns the contents of the JSON file at the given path, or None if
+    it does not exist or cannot be read (which is reported as the named
+    kind of file)"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print("! Ignoring unreadable {}: {!r}".format(name, path))
+        return None
+
+
+def save_json(path, data):
+    """Writes the data to the JSON file at the given path through a
+    temporary file, so that it is never left half written"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+class JsonCache:
+    """An on-disk cache of entries in a JSON file: a dictionary that is
+    loaded when created, and only written back by save if it changed"""
+    def __init__(self, path, name="cache"):
+        self.path = path
+        self.entries = load_json(path, name) or {}
+        self.changed = False
+
+    def save(self):
+        """Writes the cache to its file if anything was added"""
+        if not self.changed:
+            return
+        save_json(self.path, self.entries)
+        self.changed = False
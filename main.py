@@ -4,13 +4,44 @@
 """Command-line utility for the ePub compilation library"""
 import os
 import sys
-import toml
 from argparse import ArgumentParser
-from compile import compile_epub_from_specification
-from comic import compile_epub_from_folder
+from contextlib import nullcontext, redirect_stdout
+from optimize import DEVICE_PROFILES
 
-def create(spec_file, raw_spec, target_path):
+# The commands import the library where they need it, so that the slow
+# imports of markdown, PIL, toml... are only paid by the commands using them
+
+def get_stats(stats, verbose):
+    """Returns the stats sink for the --stats and --verbose options"""
+    from stats import Stats, VerboseStats
+    sink = VerboseStats if verbose else Stats
+    return sink(keep_entries=stats == "json")
+
+
+def print_stats(stats, sink):
+    """Prints the collected stats in the given format, if any. The stats
+    go to stderr, so that they can be told apart from the progress"""
+    if stats == "json":
+        print(sink.to_json(), file=sys.stderr)
+    elif stats == "text":
+        print(sink.report(), file=sys.stderr)
+
+
+def output_to(target_path):
+    """Returns the target path and the context to build in for the
+    --target_path option. With '-' the ePub is written to stdout, and the
+    progress messages go to stderr instead"""
+    if target_path == "-":
+        return (sys.stdout.buffer, redirect_stdout(sys.stderr))
+    return (target_path, nullcontext())
+
+
+def create(
+        spec_file, raw_spec, target_path, jobs, incremental, plan, stats,
+        verbose):
     """The create function"""
+    import toml
+    from compile import compile_epub_from_specification
     if not raw_spec:
         if not os.path.exists(spec_file):
             return print("Spec does not exist: '{}'".format(spec_file))
@@ -20,13 +51,125 @@ def create(spec_file, raw_spec, target_path):
 
     directory = os.path.dirname(os.path.abspath(spec_file))
 
-    compile_epub_from_specification(spec, directory, target_path=target_path)
+    if plan:
+        from plan import plan_specification
+        # Only the plan goes to stdout, so that the JSON can be piped
+        with redirect_stdout(sys.stderr):
+            build_plan = plan_specification(spec, directory)
+        return print(build_plan.to_json() if plan == "json"
+                     else build_plan.report())
+
+    sink = get_stats(stats, verbose)
+    target, context = output_to(target_path)
+    with context:
+        compile_epub_from_specification(
+            spec, directory, target_path=target, workers=jobs,
+            incremental=incremental, stats=sink)
+    print_stats(stats, sink)
 
 
-def from_folder(folder, title, author, target_path):
+def from_folder(
+        folder, title, author, target_path, probe_cache, profile, jobs, stats,
+        verbose):
     """The function to create an ePub from a folder"""
-    compile_epub_from_folder(
-        folder, title=title, author=author, path=target_path)
+    from comic import compile_epub_from_folder
+    sink = get_stats(stats, verbose)
+    target, context = output_to(target_path)
+    with context:
+        compile_epub_from_folder(
+            folder, title=title, author=author, path=target,
+            probe_cache=probe_cache, profile=profile, workers=jobs,
+            stats=sink)
+    print_stats(stats, sink)
+
+
+def batch(specs, jobs, output_dir, summary):
+    """The function to compile many specs in one process"""
+    from batch import find_specs, compile_batch
+    spec_paths = find_specs(specs)
+    if not spec_paths:
+        return print("No specs found in: {}".format(", ".join(specs)))
+    result = compile_batch(
+        spec_paths, workers=jobs, output_dir=output_dir, summary_path=summary)
+    print("Compiled {} of {} books in {:.1f}s".format(
+        result["succeeded"], len(spec_paths), result["duration"]),
+        file=sys.stderr)
+    if result["failed"]:
+        sys.exit(1)
+
+
+def watch(spec_file, target_path, interval, jobs):
+    """The function to keep an ePub up to date with its spec"""
+    from watch import watch as watch_spec
+    if not os.path.exists(spec_file):
+        return print("Spec does not exist: '{}'".format(spec_file))
+    try:
+        watch_spec(
+            spec_file, target_path=target_path, interval=interval,
+            workers=jobs)
+    except KeyboardInterrupt:
+        pass
+
+
+def index(folder, jobs):
+    """The function to update the full-text index of a library"""
+    from search import SearchIndex
+    if not os.path.isdir(folder):
+        return print("Folder does not exist: '{}'".format(folder))
+    with SearchIndex(folder) as search_index:
+        search_index.update(workers=jobs)
+
+
+def join_query(args):
+    """Joins the query arguments of the command-line into a query, where an
+    argument with whitespace (that was quoted in the shell) is a phrase"""
+    parts = []
+    for arg in args:
+        if len(arg.split()) > 1:
+            arg = '"{}"'.format(arg.replace('"', ""))
+        parts.append(arg)
+    return " ".join(parts)
+
+
+def search(folder, query, limit):
+    """The function to search the full-text index of a library"""
+    from search import SearchIndex, INDEX_FILENAME
+    if not os.path.exists(os.path.join(folder, INDEX_FILENAME)):
+        return print("No index in '{}', run 'index' first".format(folder))
+    with SearchIndex(folder) as search_index:
+        results = search_index.search(join_query(query), limit=limit)
+    for result in results:
+        print("- {} by {}: {} ({} matches) [{}]".format(
+            result.title, result.author, result.chapter, result.matches,
+            result.path))
+    if not results:
+        print("No matches")
+
+
+def catalog(folder, jobs, list_books):
+    """The function to update (and list) the metadata catalog of a library"""
+    from catalog import Catalog
+    if not os.path.isdir(folder):
+        return print("Folder does not exist: '{}'".format(folder))
+    with Catalog(folder) as book_catalog:
+        if list_books is None:
+            return book_catalog.update(workers=jobs)
+        # Keep stdout for the listing
+        with redirect_stdout(sys.stderr):
+            book_catalog.update(workers=jobs)
+        print(book_catalog.to_json() if list_books == "json"
+              else book_catalog.report())
+
+
+def add_stats_arguments(parser):
+    """Adds the options for the stats and messages of a build"""
+    parser.add_argument(
+        "-s", "--stats", choices=("text", "json"), default=None,
+        help="""Print the time spent and bytes processed in every stage of
+        the build to stderr (json also lists every entry)""")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="""Print a line for every chapter and image added""")
 
 
 def main(args=sys.argv[1:]):
@@ -48,12 +191,28 @@ def main(args=sys.argv[1:]):
         help="The spec of the book!")
     create_parser.add_argument(
         "-p", "--target_path", default=None,
-        help="""A specific path to compile the ePub to. Defaults to a 
-        name/author coupling in the current working directory""")
+        help="""A specific path to compile the ePub to ('-' for stdout).
+        Defaults to a name/author coupling in the current working
+        directory""")
     create_parser.add_argument(
         "-r", "--raw_spec", default=False,
         help="""Interpret the spec_file argument as the contents of the
         specification file, instead of the path to it""")
+    create_parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="""The number of processes compiling chapters in parallel
+        (0 uses every CPU core). Overrides 'workers' in the spec""")
+    create_parser.add_argument(
+        "-i", "--incremental", action="store_true",
+        help="""Only compile the chapters and images that changed since the
+        last incremental build, and copy the rest from the existing ePub""")
+    create_parser.add_argument(
+        "--plan", nargs="?", const="text", choices=("text", "json"),
+        default=None,
+        help="""Do not build anything, but print the entries the ePub would
+        have with their sizes, an estimate of the packed size from sampling,
+        and the duplicate and oversized entries""")
+    add_stats_arguments(create_parser)
 
     # ==== EPUB FROM_FOLDER ====
     comic_desc = """Creates an ePub file from the images in the given 
@@ -69,9 +228,116 @@ def main(args=sys.argv[1:]):
         help="""The author of the created book (defaults to the user)""")
     comic_parser.add_argument(
         "-p", "--target_path", default=None,
-        help="""Where to put the created file (defaults to a title/author
-        combination in the current working directory)""")
+        help="""Where to put the created file ('-' for stdout). Defaults
+        to a title/author combination in the current working directory""")
+    comic_parser.add_argument(
+        "-c", "--probe_cache", action="store_true",
+        help="""Cache the sizes of the images in a file in the folder, so
+        that rebuilding from the same images is faster""")
+    comic_parser.add_argument(
+        "-d", "--profile", default=None, choices=sorted(DEVICE_PROFILES),
+        help="""Shrink, convert and re-encode the images for the screen of
+        the given device""")
+    comic_parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="""The number of processes optimizing images in parallel
+        (0 uses every CPU core)""")
+    add_stats_arguments(comic_parser)
+
+    # ==== EPUB WATCH ====
+    watch_desc = """Compiles an ePub like 'create', and keeps the process
+    running to rebuild it whenever the specification or one of its source
+    files, image files or image folders changes. Only the chapters and images
+    that changed are compiled again."""
+    watch_parser = subparsers.add_parser("watch", description=watch_desc)
+    watch_parser.set_defaults(func=watch)
+    watch_parser.add_argument(
+        "spec_file",
+        help="The spec of the book!")
+    watch_parser.add_argument(
+        "-p", "--target_path", default=None,
+        help="""A specific path to compile the ePub to. Defaults to a 
+        name/author coupling in the current working directory""")
+    watch_parser.add_argument(
+        "-i", "--interval", type=float, default=0.2,
+        help="""How often (in seconds) to check the files for changes""")
+    watch_parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="""The number of processes compiling chapters in parallel
+        (0 uses every CPU core). Overrides 'workers' in the spec""")
+
+    # ==== EPUB BATCH ====
+    batch_desc = """Compiles the ePubs of many TOML specifications in one
+    process, so that the libraries are only loaded once. A book that fails
+    to compile does not stop the others."""
+    batch_parser = subparsers.add_parser("batch", description=batch_desc)
+    batch_parser.set_defaults(func=batch)
+    batch_parser.add_argument(
+        "specs", nargs="+",
+        help="""Directories containing spec files, or glob patterns of spec
+        files (like 'books/*/spec.toml')""")
+    batch_parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="""The number of books compiled in parallel (0 uses every CPU
+        core)""")
+    batch_parser.add_argument(
+        "-o", "--output_dir", default=None,
+        help="""Where to put the created files (defaults to the current
+        working directory)""")
+    batch_parser.add_argument(
+        "-s", "--summary", default=None,
+        help="""Write a JSON summary of the duration and output size of every
+        book to this path ('-' for stdout)""")
     
+    # ==== EPUB INDEX ====
+    index_desc = """Builds or updates a full-text index of the ePubs in a
+    folder (and its subfolders), stored in a file in the folder. Only the
+    books that were added or changed since the last update are read."""
+    index_parser = subparsers.add_parser("index", description=index_desc)
+    index_parser.set_defaults(func=index)
+    index_parser.add_argument(
+        "folder",
+        help="The folder of the library")
+    index_parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="""The number of processes reading books in parallel (0 uses
+        every CPU core)""")
+
+    # ==== EPUB SEARCH ====
+    search_desc = """Finds the chapters of the ePubs in an indexed folder
+    that contain every word and "quoted phrase" of the query."""
+    search_parser = subparsers.add_parser("search", description=search_desc)
+    search_parser.set_defaults(func=search)
+    search_parser.add_argument(
+        "folder",
+        help="The folder of the library, indexed with 'index'")
+    search_parser.add_argument(
+        "query", nargs="+",
+        help="""The words and "quoted phrases" to find (an argument with
+        spaces is a phrase)""")
+    search_parser.add_argument(
+        "-l", "--limit", type=int, default=20,
+        help="""How many chapters to list at most""")
+
+    # ==== EPUB CATALOG ====
+    catalog_desc = """Builds or updates a catalog of the title, author,
+    series, volume and tags of the ePubs in a folder (and its subfolders),
+    stored in a file in the folder. Only the package files of the books that
+    were added or changed since the last update are read."""
+    catalog_parser = subparsers.add_parser("catalog", description=catalog_desc)
+    catalog_parser.set_defaults(func=catalog)
+    catalog_parser.add_argument(
+        "folder",
+        help="The folder of the library")
+    catalog_parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="""The number of processes reading books in parallel (0 uses
+        every CPU core)""")
+    catalog_parser.add_argument(
+        "-l", "--list", dest="list_books", nargs="?", const="text",
+        choices=("text", "json"), default=None,
+        help="""Print the books of the catalog after updating it""")
+
     # Parse and run
     parsed = parser.parse_args(args)
     if not hasattr(parsed, "func"):
@@ -0,0 +1,123 @@
+# encoding: utf-8
+"""
+Optimization of image pages for the screen of a reading device: pages are
+shrunk to fit the resolution of a device profile, converted to its colour
+mode and encoded as jpeg at its quality, in a pool of processes
+"""
+import os
+import time
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from imageinfo import ImageInfo
+
+
+DeviceProfile = namedtuple("DeviceProfile", "width height mode quality")
+
+# The screens of common readers. The mode is 'L' for grayscale e-ink screens
+DEVICE_PROFILES = {
+    "eink": DeviceProfile(758, 1024, "L", 80),
+    "kindle-paperwhite": DeviceProfile(1072, 1448, "L", 85),
+    "kindle-oasis": DeviceProfile(1264, 1680, "L", 85),
+    "kobo-clara": DeviceProfile(1072, 1448, "L", 85),
+    "kobo-libra-colour": DeviceProfile(1264, 1680, "RGB", 85),
+    "tablet": DeviceProfile(1536, 2048, "RGB", 90),
+}
+
+# The result of optimizing an image: the path and size of the page to use,
+# which is the original if optimizing did not make it smaller
+OptimizedImage = namedtuple(
+    "OptimizedImage", "source path info size_in size_out seconds")
+
+
+def get_profile(profile):
+    """Returns the DeviceProfile of the given name (or profile)"""
+    if isinstance(profile, DeviceProfile):
+        return profile
+    if profile not in DEVICE_PROFILES:
+        raise Exception("Unknown device profile: {!r} (known: {})".format(
+            profile, ", ".join(sorted(DEVICE_PROFILES))))
+    return DEVICE_PROFILES[profile]
+
+
+def optimize_image(path, profile, directory, name=None):
+    """Shrinks the image at the path to fit the profile, converts it to the
+    colour mode of the profile and saves it as a jpeg with the given name in
+    the directory. The default name is made unique by a hash of the path.
+    Returns an OptimizedImage"""
+    from PIL import Image
+    start = time.perf_counter()
+    size_in = os.path.getsize(path)
+    if name is None:
+        digest = hashlib.sha1(os.path.abspath(path).encode("utf-8"))
+        name = "{}-{}.jpg".format(
+            os.path.basename(path).rsplit(".", 1)[0], digest.hexdigest()[:8])
+    with Image.open(path) as image:
+        original = ImageInfo(image.width, image.height, image.format)
+        if image.mode not in ("L", "RGB"):
+            # Transparent pixels become white, like the page behind them
+            image = image.convert("RGBA")
+            page = Image.new("RGB", image.size, (255, 255, 255))
+            page.paste(image, mask=image.getchannel("A"))
+            image = page
+        if image.mode != profile.mode:
+            image = image.convert(profile.mode)
+        if image.width > profile.width or image.height > profile.height:
+            image.thumbnail((profile.width, profile.height), Image.LANCZOS)
+        target = os.path.join(directory, name)
+        image.save(target, "JPEG", quality=profile.quality, optimize=True)
+        info = ImageInfo(image.width, image.height, "JPEG")
+
+    size_out = os.path.getsize(target)
+    fits = (original.width <= profile.width and
+            original.height <= profile.height)
+    if fits and size_out >= size_in:
+        # Already small enough, and re-encoding only made it bigger
+        os.remove(target)
+        target, info, size_out = path, original, size_in
+    seconds = time.perf_counter() - start
+    return OptimizedImage(path, target, info, size_in, size_out, seconds)
+
+
+def _optimize_or_none(path, profile, directory, name=None):
+    from PIL import Image
+    try:
+        return optimize_image(path, profile, directory, name)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print("! Could not optimize {!r}: {}".format(path, e))
+        return None
+
+
+def optimize_images(paths, profile, directory, workers=1):
+    """Optimizes the images at the given paths for the profile into the
+    directory, with the given number of processes (0 uses every CPU core).
+    Every image is saved with a name of its own, numbered by its place in
+    the list. Returns an OptimizedImage for every path, in order, or None
+    for the images that could not be optimized"""
+    profile = get_profile(profile)
+    if not workers:
+        workers = os.cpu_count() or 1
+    names = [
+        "{}-{}.jpg".format(os.path.basename(path).rsplit(".", 1)[0], num)
+        for num, path in enumerate(paths)]
+    if workers == 1:
+        return [_optimize_or_none(path, profile, directory, name)
+                for path, name in zip(paths, names)]
+
+    count = len(paths)
+    chunksize = max(1, count // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(
+            _optimize_or_none, paths, [profile] * count,
+            [directory] * count, names, chunksize=chunksize))
+
+
+def report_reduction(results, profile_name):
+    """Returns a summary of how much smaller the optimized images are"""
+    results = [result for result in results if result is not None]
+    size_in = sum(result.size_in for result in results)
+    size_out = sum(result.size_out for result in results)
+    reduction = 1 - size_out / size_in if size_in else 0.0
+    return "Optimized {} images for {!r}: {:.1f} MB -> {:.1f} MB ({:.0%} smaller)".format(
+        len(results), profile_name, size_in / 1e6, size_out / 1e6, reduction)
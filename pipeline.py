@@ -0,0 +1,179 @@
+# encoding: utf-8
+"""
+Overlaps the reading and preparing of the entries of an ePub with the
+writing of the archive: the sources are loaded ahead on background threads
+while the writer compresses and writes the previous ones. How much is loaded
+ahead is limited by a budget of bytes in flight, so that a fast reader
+cannot fill the memory while the writer is behind
+"""
+import os
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from stats import Stats
+
+
+DEFAULT_THREADS = 4
+DEFAULT_BUDGET = 16 * 1024 * 1024  # Bytes loaded ahead of the writer at most
+
+
+def read_ahead(items, load, cost, threads=DEFAULT_THREADS, budget=DEFAULT_BUDGET):
+    """Yields load(item) for every item in order, loading the next items on
+    a pool of threads while the caller is busy with the previous ones.
+    The items whose cost (their size in bytes) does not fit the budget wait
+    until earlier results are taken, but one item is always loaded"""
+    if threads < 1:
+        for item in items:
+            yield load(item)
+        return
+
+    with ThreadPoolExecutor(threads, thread_name_prefix="epub-read") as pool:
+        pending = deque()  # (future, cost)
+        in_flight = 0
+        for item in items:
+            size = cost(item)
+            while pending and in_flight + size > budget:
+                future, done = pending.popleft()
+                in_flight -= done
+                yield future.result()
+            pending.append((pool.submit(load, item), size))
+            in_flight += size
+        while pending:
+            future, _ = pending.popleft()
+            yield future.result()
+
+
+class _Producer:
+    """The shared state of produce_ahead and its background thread"""
+    def __init__(self, iterable, cost, budget):
+        self.iterable = iterable
+        self.cost = cost
+        self.budget = budget
+        self.condition = threading.Condition()
+        self.queue = deque()  # (item, cost)
+        self.in_flight = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+
+    def run(self):
+        iterator = iter(self.iterable)
+        try:
+            for item in iterator:
+                size = self.cost(item)
+                with self.condition:
+                    while (self.queue and not self.closed and
+                           self.in_flight + size > self.budget):
+                        self.condition.wait()
+                    if self.closed:
+                        return
+                    self.queue.append((item, size))
+                    self.in_flight += size
+                    self.condition.notify_all()
+        except BaseException as e:
+            self.error = e
+        finally:
+            # Let a generator clean up (eg. shut down its process pool)
+            if hasattr(iterator, "close"):
+                iterator.close()
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def take(self):
+        """Returns the next (True, item), or (False, None) at the end"""
+        with self.condition:
+            while not self.queue and not self.done:
+                self.condition.wait()
+            if self.queue:
+                item, size = self.queue.popleft()
+                self.in_flight -= size
+                self.condition.notify_all()
+                return (True, item)
+            if self.error is not None:
+                raise self.error
+            return (False, None)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+
+
+def produce_ahead(iterable, cost, budget=DEFAULT_BUDGET):
+    """Yields the items of the iterable, which is run on a background thread
+    from the first item on, so that the next items are produced while the
+    caller is busy. The items whose cost does not fit the budget wait until
+    earlier items are taken, but one item is always produced ahead"""
+    producer = _Producer(iterable, cost, budget)
+    thread = threading.Thread(
+        target=producer.run, name="epub-produce", daemon=True)
+    thread.start()
+    try:
+        while True:
+            found, item = producer.take()
+            if not found:
+                return
+            yield item
+    finally:
+        producer.close()
+        thread.join()
+
+
+def load_image(item, size, max_size=DEFAULT_BUDGET // 4, stats=None):
+    """Loads and hashes the image of a (name, filename, image) item whose
+    image is a path of the given size, unless it is bigger than the max
+    size (it is streamed from the disk by the writer then).
+    Returns a (name, filename, image, content hash or None) item"""
+    name, filename, image = item
+    if not isinstance(image, str) or size > max_size:
+        return (name, filename, image, None)
+    if stats is None:
+        stats = Stats()
+    with stats.timer("load", filename, bytes_in=size, bytes_out=size):
+        with open(image, "rb") as f:
+            data = f.read()
+        # Hashing here keeps it off the thread that writes the archive
+        digest = hashlib.sha1(data).hexdigest()
+    return (name, filename, data, digest)
+
+
+def chapter_cost(item):
+    """The bytes that a prepared (title, filename, text) chapter takes"""
+    text = item[2]
+    return len(text) if isinstance(text, (str, bytes)) else 0
+
+
+def prefetch_images(
+        images, threads=DEFAULT_THREADS, budget=DEFAULT_BUDGET, stats=None):
+    """Reads and hashes the image files of the (name, filename, image) items
+    ahead on threads, within the budget of bytes. Images bigger than a
+    quarter of the budget are still streamed from the disk by the writer.
+    Yields (name, filename, image, content hash or None) items"""
+    if threads < 1:
+        return ((name, filename, image, None)
+                for name, filename, image in images)
+    max_size = budget // 4
+
+    def sized_images():
+        for item in images:
+            image = item[2]
+            yield (item, os.path.getsize(image) if isinstance(image, str) else 0)
+
+    def cost(sized):
+        return sized[1] if sized[1] <= max_size else 0
+
+    return read_ahead(
+        sized_images(), lambda sized: load_image(*sized, max_size, stats),
+        cost, threads, budget)
+
+
+def prefetch_chapters(chapters, threads=DEFAULT_THREADS, budget=DEFAULT_BUDGET):
+    """Prepares the (title, filename, text) chapters ahead on a background
+    thread, within the budget of bytes"""
+    if threads < 1:
+        return iter(chapters)
+    return produce_ahead(chapters, chapter_cost, budget)
@@ -0,0 +1,240 @@
+# encoding: utf-8
+"""
+Dry runs of builds: resolves every chapter, image and cover of a
+specification like a build would, without compiling or compressing it, and
+estimates the size of the ePub by deflating samples of the entries. Used to
+size (and route) builds before spending CPU time on them
+"""
+import os
+import json
+import time
+import zipfile
+from collections import namedtuple
+
+from spec_validator import validate_spec
+from compile import (
+    split_chapters, stream_chapters, load_source_text, iter_load_images)
+from charset import SourceDecoder, EncodingCache, DEFAULT_DETECT_LIMIT
+from writer import (
+    CompressionPolicy, compress, hash_file, get_image_type, XHTML_MEDIA_TYPE,
+    TITLE_FILENAME, TOC_FILENAME)
+
+
+# How much of every entry is deflated to estimate its compressed size, and
+# how much at most in all (the rest is estimated from the average ratio)
+SAMPLE_BYTES = 16 * 1024
+SAMPLE_BUDGET = 4 * 1024 * 1024
+
+# Entries bigger than this are reported. Older readers handle chapters of
+# more than about 300 KB badly, and big images mostly waste space
+OVERSIZED_CHAPTER_BYTES = 300 * 1024
+OVERSIZED_IMAGE_BYTES = 5 * 1024 * 1024
+
+# An entry of a planned ePub. The size is that of the source: markdown
+# chapters are compiled to a somewhat bigger html page. The estimate is the
+# estimated compressed size, which is 0 for images stored once already
+PlannedEntry = namedtuple(
+    "PlannedEntry",
+    "id href media_type source size estimate duplicate_of notes")
+
+
+class BuildPlan:
+    """The entries that a build of a specification would write, in the
+    order they are written (the cover, the images, then the chapters)"""
+    def __init__(self, title, author, entries, sampled_bytes, sample_seconds):
+        self.title = title
+        self.author = author
+        self.entries = entries  # [PlannedEntry]
+        self.sampled_bytes = sampled_bytes
+        self.sample_seconds = sample_seconds
+
+    def chapters(self):
+        return [e for e in self.entries if e.media_type == XHTML_MEDIA_TYPE]
+
+    def images(self):
+        return [e for e in self.entries if e.media_type != XHTML_MEDIA_TYPE]
+
+    def manifest(self):
+        """Returns the (id, href) of the manifest of content.opf in order"""
+        return ([("title", TITLE_FILENAME)] +
+                [(e.id, e.href) for e in self.chapters()] +
+                [(e.id, e.href) for e in self.images()
+                 if e.duplicate_of is None] +
+                [("ncx", TOC_FILENAME)])
+
+    def spine(self):
+        """Returns the ids of the spine in reading order"""
+        return ["title"] + [e.id for e in self.chapters()]
+
+    def size(self):
+        return sum(e.size for e in self.entries)
+
+    def estimated_size(self):
+        return sum(e.estimate for e in self.entries)
+
+    def estimated_compress_seconds(self):
+        """Extrapolates how long deflating the entries takes from how long
+        deflating the samples took"""
+        if not self.sampled_bytes:
+            return 0.0
+        deflated = sum(
+            e.size for e in self.entries
+            if e.estimate and e.estimate != e.size)
+        return self.sample_seconds * deflated / self.sampled_bytes
+
+    def as_dict(self):
+        """Returns the plan as a JSON serializable dictionary"""
+        return {
+            "title": self.title,
+            "author": self.author,
+            "size": self.size(),
+            "estimated_size": self.estimated_size(),
+            "estimated_compress_seconds": round(
+                self.estimated_compress_seconds(), 3),
+            "manifest": [
+                {"id": item_id, "href": href}
+                for item_id, href in self.manifest()],
+            "spine": self.spine(),
+            "entries": [entry._asdict() for entry in self.entries],
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def report(self):
+        """Returns a table of the entries, with their notes and the totals"""
+        lines = ["{:40} {:>11} {:>11}  {}".format(
+            "entry", "KB", "~KB packed", "notes")]
+        for entry in self.entries:
+            lines.append("{:40} {:11.1f} {:11.1f}  {}".format(
+                entry.href[:40], entry.size / 1024, entry.estimate / 1024,
+                "; ".join(entry.notes)))
+        lines.append(
+            "{} chapters, {} images: {:.2f} MB of sources, ~{:.2f} MB "
+            "packed, ~{:.2f}s of compression".format(
+                len(self.chapters()), len(self.images()), self.size() / 1e6,
+                self.estimated_size() / 1e6,
+                self.estimated_compress_seconds()))
+        return "\n".join(lines)
+
+
+class _Sampler:
+    """Estimates the compressed sizes of entries by deflating their first
+    bytes, until the budget of sampled bytes is spent"""
+    def __init__(self, policy, budget=SAMPLE_BUDGET):
+        self.policy = policy
+        self.budget = budget
+        self.sampled = 0
+        self.compressed = 0
+        self.seconds = 0.0
+
+    def ratio(self):
+        return self.compressed / self.sampled if self.sampled else 1.0
+
+    def estimate(self, href, size, read_sample):
+        """Returns the estimated compressed size of the entry, where
+        read_sample returns (at least) the first bytes of the entry"""
+        compress_type, level = self.policy.compression_for(href)
+        if compress_type != zipfile.ZIP_DEFLATED:
+            return size
+        if self.sampled >= self.budget or not size:
+            return round(size * self.ratio())
+        sample = read_sample()[:SAMPLE_BYTES]
+        start = time.perf_counter()
+        compressed = len(compress(sample, compress_type, level).data)
+        self.seconds += time.perf_counter() - start
+        self.sampled += len(sample)
+        self.compressed += compressed
+        return round(size * compressed / len(sample)) if sample else 0
+
+
+def _read_head(path):
+    with open(path, "rb") as f:
+        return f.read(SAMPLE_BYTES)
+
+
+def _oversized(size, limit):
+    if size > limit:
+        return ["oversized: {:.0f} KB > {:.0f} KB".format(
+            size / 1024, limit / 1024)]
+    return []
+
+
+def plan_specification(spec_dict, directory):
+    """Plans the build of the given specification, like
+    compile.compile_epub_from_specification, without compiling anything.
+    The sources are read to split them into chapters, and the images that
+    have the same size as another are hashed to find the duplicates.
+    Returns a BuildPlan"""
+    validate_spec(spec_dict, directory)
+    sampler = _Sampler(CompressionPolicy.from_spec(spec_dict.get("compression")))
+    entries = []
+    hrefs = {}  # href -> the id of the first entry with it
+
+    def add(item_id, href, media_type, source, size, estimate,
+            duplicate_of=None, notes=()):
+        notes = list(notes)
+        if duplicate_of is None and href in hrefs:
+            notes.append("same filename as {!r}".format(hrefs[href]))
+        hrefs.setdefault(href, item_id)
+        entries.append(PlannedEntry(
+            item_id, href, media_type, source, size, estimate, duplicate_of,
+            notes))
+
+    # Images, which are stored once per distinct content
+    cover_path = os.path.join(directory, spec_dict["cover_file"])
+    cover_type = cover_path.rsplit(".", 1)[-1]
+    images = [("cover", "cover." + cover_type.replace(".", ""), cover_path)]
+    images.extend(iter_load_images(
+        directory, spec_dict.get("image_files", {}),
+        image_folders=spec_dict.get("image_folders", [])))
+    sizes = [os.path.getsize(path) for _, _, path in images]
+    same_size = {}
+    for size in sizes:
+        same_size[size] = same_size.get(size, 0) + 1
+    stored = {}  # content hash -> href
+    for (name, filename, path), size in zip(images, sizes):
+        duplicate_of = None
+        if same_size[size] > 1:
+            digest = hash_file(path)
+            duplicate_of = stored.get(digest)
+            stored.setdefault(digest, filename)
+        notes = _oversized(size, OVERSIZED_IMAGE_BYTES)
+        if duplicate_of is not None:
+            notes.append("same content as {!r}".format(duplicate_of))
+            estimate = 0
+        else:
+            estimate = sampler.estimate(
+                filename, size, lambda: _read_head(path))
+        add(name, filename, get_image_type(filename), path, size, estimate,
+            duplicate_of, notes)
+
+    # Chapters, split like a build splits them
+    decoder = SourceDecoder(
+        {os.path.join(directory, f): encoding for f, encoding
+         in spec_dict.get("source_encodings", {}).items()},
+        cache=EncodingCache(directory),
+        limit=spec_dict.get("encoding_detection_limit", DEFAULT_DETECT_LIMIT))
+    for source in spec_dict["source_files"]:
+        path = os.path.join(directory, source)
+        if path.endswith(".md"):
+            if spec_dict.get("stream_sources", False):
+                chapters = stream_chapters(path, decoder=decoder)
+            else:
+                chapters = split_chapters(
+                    load_source_text(path, decoder=decoder))
+            for chapter_name, name, lines in chapters:
+                data = "\n".join(lines).encode("utf-8")
+                add(chapter_name, name, XHTML_MEDIA_TYPE, path, len(data),
+                    sampler.estimate(name, len(data), lambda: data),
+                    notes=_oversized(len(data), OVERSIZED_CHAPTER_BYTES))
+        else:
+            base = os.path.basename(path)
+            size = os.path.getsize(path)
+            add(base.rsplit(".", 1)[0], base, XHTML_MEDIA_TYPE, path, size,
+                sampler.estimate(base, size, lambda: _read_head(path)),
+                notes=_oversized(size, OVERSIZED_CHAPTER_BYTES))
+
+    return BuildPlan(
+        spec_dict["title"], spec_dict["author"], entries, sampler.sampled,
+        sampler.seconds)
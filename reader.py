@@ -0,0 +1,303 @@
+# encoding: utf-8
+"""Classes and utilities for reading ePub files"""
+import os
+import sys
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import unquote
+
+
+# Globals
+CONTAINER_PATH = "META-INF/container.xml"
+NCX_MEDIA_TYPE = "application/x-dtbncx+xml"
+DEFAULT_CACHE_SIZE = 16
+DEFAULT_COMMIT_EVERY = 100  # Books stored per transaction by update_books
+
+
+def findall(source_node, tag):
+    """Iterates over all tags of the given type below the given node"""
+    for item in source_node.iter():
+        if item.tag.endswith(tag):
+            yield item
+
+
+def find(source_node, tag):
+    """Returns the first instance of tag below the given node"""
+    for item in source_node.iter():
+        if item.tag.endswith(tag):
+            return item
+
+
+def read_metadata(package_root):
+    """Reads the metadata of the given parsed package (.opf) file.
+    Returns a dictionary like the metadata of a specification, with an
+    empty title and author if the package has no metadata"""
+    metadata_root = find(package_root, "metadata")
+    if metadata_root is None:
+        metadata_root = ET.Element("metadata")
+
+    def get(tag):
+        return [item.text or "" for item in findall(metadata_root, tag)]
+
+    titles = get("title")
+    creators = get("creator")
+    languages = get("language")
+    descriptions = get("description")
+    metadata = {
+        "title": titles[0] if titles else "",
+        "author": creators[0] if creators else "",
+        "tags": [tag for tag in get("subject") if tag != "Series"],
+    }
+    if languages:
+        metadata["language"] = languages[0]
+    if descriptions:
+        metadata["description"] = descriptions[0]
+
+    for meta in findall(metadata_root, "meta"):
+        name = meta.get("name")
+        if name == "calibre:series":
+            metadata["series"] = meta.get("content")
+        elif name == "calibre:series_index":
+            metadata["volume"] = meta.get("content")
+    return metadata
+
+
+def read_package_path(archive):
+    """Returns the path of the package (.opf) file of the open ZipFile"""
+    container_root = ET.fromstring(archive.read(CONTAINER_PATH))
+    return find(container_root, "rootfile").get("full-path")
+
+
+def find_books(folder):
+    """Returns the paths of the ePubs in the folder and its subfolders"""
+    paths = []
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if filename.lower().endswith(".epub"):
+                paths.append(os.path.abspath(os.path.join(dirpath, filename)))
+    return sorted(paths)
+
+
+def update_books(db, folder, read, add, remove, workers=1,
+                 commit_every=DEFAULT_COMMIT_EVERY):
+    """Brings the books table (id, path, mtime_ns, size) of the sqlite
+    database of a library up to date with the ePubs in the folder: the
+    books that are gone or changed are removed with remove(book ids), and
+    the new or changed ones are read with read(path) -> (result, error) in
+    the given number of processes (0 uses every CPU core) and stored with
+    add(path, stat, result, error). Returns the number of (read, unchanged,
+    removed) books"""
+    known = {
+        path: (book_id, mtime_ns, size)
+        for book_id, path, mtime_ns, size in db.execute(
+            "SELECT id, path, mtime_ns, size FROM books")}
+    changed = []
+    replaced = []
+    unchanged = 0
+    for path in find_books(folder):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # Gone since it was found
+        entry = known.pop(path, None)
+        if entry is not None:
+            if entry[1:] == (stat.st_mtime_ns, stat.st_size):
+                unchanged += 1
+                continue
+            replaced.append(entry[0])
+        changed.append((path, stat))
+    remove(replaced + [book_id for book_id, _, _ in known.values()])
+    db.commit()
+
+    if not workers:
+        workers = os.cpu_count() or 1
+    paths = [path for path, _ in changed]
+    if workers == 1 or len(paths) < 2:
+        results = map(read, paths)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        chunksize = max(1, min(256, len(paths) // (workers * 8)))
+        results = pool.map(read, paths, chunksize=chunksize)
+    done = 0
+    try:
+        for (path, stat), (result, error) in zip(changed, results):
+            if error is not None:
+                print("! Could not read {!r}: {}".format(path, error))
+            add(path, stat, result, error)
+            done += 1
+            if done % commit_every == 0:
+                db.commit()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        db.commit()
+    return (done, unchanged, len(known))
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the text of a html document, a line per block"""
+    blocks = frozenset([
+        "p", "div", "br", "li", "tr", "blockquote", "pre",
+        "h1", "h2", "h3", "h4", "h5", "h6",
+    ])
+    skipped = frozenset(["head", "script", "style"])
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipped:
+            self.skipping += 1
+        elif tag in self.blocks:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.skipped:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.blocks:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+    def text(self):
+        lines = (line.strip() for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+def extract_text(html):
+    """Returns the text contents of the given html document"""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+
+class EpubReader:
+    """An ePub archive open for reading.
+    Opening it only reads the zip directory, the container and the package
+    (.opf) file. Chapters are decompressed when they are asked for, and the
+    most recently used ones are kept in a cache of the given size"""
+    def __init__(self, path, cache_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # member -> text
+        self._titles = None  # The chapter titles of the table of contents
+        self.file = zipfile.ZipFile(path)
+        try:
+            self.package_path = read_package_path(self.file)
+            package_root = ET.fromstring(self.file.read(self.package_path))
+            manifest_root = find(package_root, "manifest")
+            spine_root = find(package_root, "spine")
+            for name, root in (("manifest", manifest_root),
+                               ("spine", spine_root)):
+                if root is None:
+                    raise Exception("No {} in the package file {!r} of {!r}"
+                                    .format(name, self.package_path, path))
+        except Exception:
+            self.file.close()
+            raise
+        package_dir = posixpath.dirname(self.package_path)
+
+        self.metadata = read_metadata(package_root)
+        self.title = self.metadata["title"]
+        self.author = self.metadata["author"]
+
+        # id -> (member, media_type), with the members relative to the root
+        self.manifest = OrderedDict()
+        for item in findall(manifest_root, "item"):
+            member = posixpath.normpath(
+                posixpath.join(package_dir, unquote(item.get("href"))))
+            self.manifest[item.get("id")] = (member, item.get("media-type"))
+
+        self.spine = [
+            ref.get("idref")
+            for ref in findall(spine_root, "itemref")
+            if ref.get("idref") in self.manifest]
+
+
+    def read(self, member):
+        """Returns the decoded text of the given member of the archive"""
+        text = self._cache.get(member)
+        if text is not None:
+            self._cache.move_to_end(member)
+            return text
+        text = self.file.read(member).decode("utf-8", errors="replace")
+        self._cache[member] = text
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return text
+
+
+    def titles(self):
+        """Returns a dictionary of chapter title -> member from the table of
+        contents (.ncx) of the ePub, which is read the first time"""
+        if self._titles is None:
+            self._titles = {}
+            for member, media_type in self.manifest.values():
+                if media_type != NCX_MEDIA_TYPE:
+                    continue
+                toc_dir = posixpath.dirname(member)
+                toc_root = ET.fromstring(self.file.read(member))
+                for nav_point in findall(toc_root, "navPoint"):
+                    label = find(nav_point, "text")
+                    content = find(nav_point, "content")
+                    if label is None or content is None:
+                        continue
+                    src = unquote(content.get("src").split("#", 1)[0])
+                    self._titles[label.text] = posixpath.normpath(
+                        posixpath.join(toc_dir, src))
+        return self._titles
+
+
+    def find_chapter(self, title):
+        """Returns the member of the chapter with the given title, which is
+        either its id in the manifest or its title in the table of contents"""
+        if title in self.manifest:
+            return self.manifest[title][0]
+        member = self.titles().get(title)
+        if member is None:
+            raise KeyError("No chapter titled {!r} in {!r}".format(
+                title, self.path))
+        return member
+
+
+    def get_chapter(self, title):
+        """Returns the (x)html text of the chapter with the given title"""
+        return self.read(self.find_chapter(title))
+
+
+    def iter_chapters(self):
+        """Iterates over the (id, member) of the chapters in spine order"""
+        for item_id in self.spine:
+            yield (item_id, self.manifest[item_id][0])
+
+
+    def iter_text(self):
+        """Iterates over the (id, text contents) of the chapters in spine
+        order, decompressing one chapter at a time"""
+        for item_id, member in self.iter_chapters():
+            html = self.file.read(member).decode("utf-8", errors="replace")
+            yield (item_id, extract_text(html))
+
+
+    def print_text(self, file=sys.stdout):
+        """Prints the text contents of the ePub, a chapter at a time"""
+        for _, text in self.iter_text():
+            if text:
+                print(text, file=file)
+                print(file=file)
+
+
+    def close(self):
+        """Closes the underlying archive"""
+        self._cache.clear()
+        self.file.close()
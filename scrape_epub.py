@@ -6,39 +6,31 @@ Scrapes the content of an ePub for easy editing and repackaging
 """
 import os
 import sys
+import shutil
 import xml.etree.ElementTree as ET
 import zipfile
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-import toml
-from bs4 import BeautifulSoup
-from bs4.element import NavigableString
+from reader import find, findall, read_metadata, read_package_path
+
+# bs4 and toml are imported where they are needed, since importing them is slow
 
 # Globals
-CONTAINER_PATH = "META-INF/container.xml"
 IMAGE_EXTENSIONS = (
     ".png",
     ".jpg",
     ".jpeg"
 )
+COPY_CHUNK_SIZE = 1024 * 1024
 
 # Other stuff
 
-def findall(source_node, tag):
-    """Iterates over all tags of the given type below the given node"""
-    for item in source_node.iter():
-        if item.tag.endswith(tag):
-            yield item
-
-def find(source_node, tag):
-    """Returns the first instance of tag below the given node"""
-    for item in source_node.iter():
-        if item.tag.endswith(tag):
-            return item
-
 ITALIC_TAGS = set(["i", "em"])
 def format_item(tag):
     """Formats an item on a html line for markdown"""
+    from bs4.element import NavigableString
     bucket = []
     # Simple string
     if type(tag) == NavigableString:
@@ -75,31 +67,89 @@ def format_item(tag):
     
     return bucket
 
-def scrape_metadata(zip_archive):
-    """Scrapes the metadata of an ePub from a given open ZipFile object"""
-    # Locate the .opf file (this is just for compatibility, I think?)
-    container_root = ET.fromstring(zip_archive.read(CONTAINER_PATH))
-    
-    meta_path = find(container_root, "rootfile").get("full-path")
-    
-    # Open the opf file
-    meta_root = ET.fromstring(zip_archive.read(meta_path))
-    metadata_root = find(meta_root, "metadata")
+_parser = None
+def get_parser():
+    """Returns the html parser for BeautifulSoup: lxml if it can be
+    imported, else the standard library's. Unlike the default choice of
+    BeautifulSoup, the slow html5lib is never picked. Decided once per
+    process"""
+    global _parser
+    if _parser is None:
+        try:
+            import lxml
+            _parser = "lxml"
+        except ImportError:
+            _parser = "html.parser"
+    return _parser
+
+
+def convert_document(html, num, parser=None):
+    """Converts a html document of the spine to markdown. num is its place
+    in the spine, as every document after the first starts a new chapter.
+    The parser defaults to get_parser()"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, parser or get_parser())
+    lines = []
+    # For each line in a nice eBook
+    for line_num, tag in enumerate(soup.body.find_all(recursive=False)):
+        
+        # A title of some sort
+        if tag.name.startswith("h"):
+            # New file (prepare for a split here) => automatic h1 (for now)
+            if num and line_num == 0:
+                line_parts = ["# ", tag.text]
+            
+            else:
+                level = int(tag.name[1:])
+                line_parts = [("#"*level) + " ", tag.text]
     
-    def get(tag, default=None):
-        items = [item.text for item in findall(metadata_root, tag)]
-        if not items:
-            return default
+        # Just some text (maybe with images)
         else:
-            if len(items) == 1:
-                return items[0]
-            else:
-                return items    
+            line_parts = format_item(tag)
     
-    title = get("title", "") 
-    tags = get("subject", [])
-    author = get("creator", "")
-    language = get("language", "")
+        # Strip the line
+        if line_parts:
+            line_parts[0] = line_parts[0].lstrip()
+            line_parts[-1] = line_parts[-1].rstrip()
+        
+        line_parts.append("\n")
+        lines.append("".join(line_parts))
+    return "".join(lines)
+
+
+def iter_converted_documents(
+        zip_archive, spine_list, workers=1, max_in_flight=None):
+    """Converts the documents of the spine to markdown, and yields them in
+    spine order. With more than one worker, they are converted by a pool of
+    processes, with at most max_in_flight (default: twice the workers)
+    documents submitted at a time"""
+    if workers == 1:
+        for num, source_file in enumerate(spine_list):
+            yield convert_document(zip_archive.read(source_file), num)
+        return
+    
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    # The documents are read here, so the archive may also be a stream
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for num, source_file in enumerate(spine_list):
+            pending.append(pool.submit(
+                convert_document, zip_archive.read(source_file), num))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def scrape_metadata(zip_archive, workers=1):
+    """Scrapes the metadata of an ePub from a given open ZipFile object.
+    The spine documents are converted by the given number of processes"""
+    # Open the opf file, which the container points to
+    meta_path = read_package_path(zip_archive)
+    meta_root = ET.fromstring(zip_archive.read(meta_path))
+    metadata = read_metadata(meta_root)
+    title = metadata["title"]
     
     # Map the spine Ids to item references and find the images in the ePub
     item_map = {}
@@ -126,8 +176,8 @@ def scrape_metadata(zip_archive):
         if item.filename.lower().endswith(IMAGE_EXTENSIONS):
             image = item.filename
             image_path = title + "-" + image
-            with open(image_path, "wb") as f:
-                f.write(zip_archive.read(image))
+            with zip_archive.open(image) as src, open(image_path, "wb") as f:
+                shutil.copyfileobj(src, f, COPY_CHUNK_SIZE)
                 print("- Saved image to '{}'".format(image_path))
             image_paths[image] = image_path
     
@@ -138,67 +188,47 @@ def scrape_metadata(zip_archive):
     print("Writing source file...")
     source_path = title + "-source.md"
     with open(source_path, "w") as f:
-        for num, source_file in enumerate(spine_list):
-            soup = BeautifulSoup(zip_archive.read(source_file))
-            # For each line in a nice eBook
-            for line_num, tag in enumerate(soup.body.find_all(recursive=False)):
-                
-                # A title of some sort
-                if tag.name.startswith("h"):
-                    # New file (prepare for a split here) => automatic h1 (for now)
-                    if num and line_num == 0:
-                        line_parts = ["# ", tag.text]
-                    
-                    else:
-                        level = int(tag.name[1:])
-                        line_parts = [("#"*level) + " ", tag.text]
-            
-                # Just some text (maybe with images)
-                else:
-                    line_parts = format_item(tag)
-            
-                # Strip the line
-                if line_parts:
-                    line_parts[0] = line_parts[0].lstrip()
-                    line_parts[-1] = line_parts[-1].rstrip()
-                
-                # Write the line to the output file
-                line_parts.append("\n")
-                f.write("".join(line_parts))
+        documents = iter_converted_documents(
+            zip_archive, spine_list, workers=workers)
+        for source_file, markdown in zip(spine_list, documents):
+            f.write(markdown)
             print("- Wrote '{}'".format(source_file))
     
     print("Saved the source to '{}'".format(source_path))
     
     cover_path = title + "-cover." + cover_file.split(".")[-1]
-    meta = {
-        "title": title,
-        "author": author,
+    # The title, author and tags, and the language, description, series
+    # and volume where the ePub has them
+    meta = dict(metadata)
+    meta.update({
         "cover_file": cover_path,
         "source_file": source_path,
-        "tags": tags,
         "image_files": image_paths
-    }
-    if language:
-        meta["language"] = language
+    })
 
     # Write the metadata
+    import toml
     spec_path = title + "-spec.toml"
     with open(spec_path, "w") as f:
         toml.dump(meta, f)
         print("Saved the spec to '{}'".format(spec_path))
 
-def scrape_epub(filepath):
+def scrape_epub(filepath, workers=1):
     """Scrapes everything out of that epub /yay/"""
     with zipfile.ZipFile(filepath) as file:
-        scrape_metadata(file)
+        scrape_metadata(file, workers=workers)
 
 def main(args=sys.argv[1:]):
     """Entry point"""
     parser = ArgumentParser()
     parser.add_argument("epub", help="The path of the ePub to scrape")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="""The number of processes converting the chapters to markdown
+        (0 uses every CPU core)""")
     
     parsed = parser.parse_args(args)
-    scrape_epub(parsed.epub)
+    scrape_epub(parsed.epub, workers=parsed.jobs or os.cpu_count() or 1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,286 @@
+# encoding: utf-8
+"""
+A full-text index of a library of ePubs: an inverted index in an SQLite
+file, with the positions of every term in every chapter, so that terms and
+phrases are found without opening the books. The index is updated
+incrementally: only the books that were added or changed (by modification
+time and size) since the last update are read again
+"""
+import os
+import re
+import sys
+import html
+import time
+import sqlite3
+from array import array
+from itertools import accumulate
+from collections import namedtuple, defaultdict
+
+from reader import EpubReader, update_books
+
+
+INDEX_FILENAME = ".epub-index.sqlite"
+INDEX_VERSION = 2  # Indexes of other versions are built again
+DEFAULT_LIMIT = 20
+COMMIT_EVERY = 100  # Books indexed per transaction
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT,
+    author TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    id INTEGER PRIMARY KEY,
+    book_id INTEGER NOT NULL,
+    item_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chapters_book ON chapters (book_id);
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL,
+    chapter_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    positions BLOB NOT NULL,
+    PRIMARY KEY (term_id, chapter_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_chapter ON postings (chapter_id);
+"""
+
+_word_pattern = re.compile(r"\w+")
+# Only the words of the chapters are indexed, so stripping the tags is
+# enough (and much faster than parsing them like reader.extract_text)
+_skipped_pattern = re.compile(
+    r"<(head|script|style)\b.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+_tag_pattern = re.compile(r"<[^>]*>")
+_query_pattern = re.compile(r'"([^"]*)"|(\S+)')
+
+# A chapter found by a search, with how many times the query matched in it
+SearchResult = namedtuple(
+    "SearchResult", "path title author chapter matches")
+
+
+def tokenize(text):
+    """Returns the lowercased words of the text, in order"""
+    return _word_pattern.findall(text.lower())
+
+
+def html_words(document):
+    """Returns the lowercased words of the text of the html document"""
+    text = _tag_pattern.sub(" ", _skipped_pattern.sub(" ", document))
+    return tokenize(html.unescape(text))
+
+
+def encode_positions(positions):
+    """Encodes the increasing positions as the differences between them, in
+    an array of the smallest integer type that fits them, after a byte with
+    the type code of the array"""
+    deltas = [b - a for a, b in zip([0] + positions, positions)]
+    largest = max(deltas)
+    typecode = "B" if largest < 0x100 else "H" if largest < 0x10000 else "L"
+    data = array(typecode, deltas)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return typecode.encode("ascii") + data.tobytes()
+
+
+def _deltas(data):
+    deltas = array(chr(data[0]))
+    deltas.frombytes(data[1:])
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return deltas
+
+
+def decode_positions(data):
+    """Decodes the positions encoded by encode_positions"""
+    return list(accumulate(_deltas(data)))
+
+
+def _phrase_starts(data, offset):
+    """Returns the set of the encoded positions minus the offset, which are
+    where a phrase starts if the term is at the offset of the phrase"""
+    starts = accumulate(_deltas(data), initial=-offset)
+    next(starts)  # The initial value itself
+    return set(starts)
+
+
+def read_book(path):
+    """Reads the text of the chapters of the ePub at the given path.
+    Returns the (title, author, chapters) of the book, with a
+    (item id, [(term, count, encoded positions)]) for every chapter"""
+    reader = EpubReader(path)
+    try:
+        chapters = []
+        for item_id, member in reader.iter_chapters():
+            document = reader.file.read(member).decode(
+                "utf-8", errors="replace")
+            positions = defaultdict(list)
+            for position, term in enumerate(html_words(document)):
+                positions[term].append(position)
+            chapters.append((item_id, [
+                (term, len(found), encode_positions(found))
+                for term, found in positions.items()]))
+        return (reader.title, reader.author, chapters)
+    finally:
+        reader.close()
+
+
+def _read_or_error(path):
+    """Returns (the book read by read_book, None), or (None, the error) if
+    the ePub cannot be read"""
+    try:
+        return (read_book(path), None)
+    except Exception as e:
+        return (None, "{}: {}".format(type(e).__name__, e))
+
+
+class SearchIndex:
+    """The full-text index of the ePubs in a folder, stored in a file in
+    the folder (or at the given path)"""
+    def __init__(self, folder, path=None):
+        self.folder = folder
+        self.path = path or os.path.join(folder, INDEX_FILENAME)
+        self.db = sqlite3.connect(self.path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != INDEX_VERSION:
+            self.db.executescript(
+                "DROP TABLE IF EXISTS postings; DROP TABLE IF EXISTS terms;"
+                "DROP TABLE IF EXISTS chapters; DROP TABLE IF EXISTS books;")
+            self.db.execute("PRAGMA user_version = {}".format(INDEX_VERSION))
+        self.db.executescript(_SCHEMA)
+        self._term_ids = None
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def term_id(self, term):
+        """Returns the id of the term, adding it to the index if it is new"""
+        if self._term_ids is None:
+            self._term_ids = dict(self.db.execute("SELECT term, id FROM terms"))
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            term_id = self.db.execute(
+                "INSERT INTO terms (term) VALUES (?)", (term,)).lastrowid
+            self._term_ids[term] = term_id
+        return term_id
+
+    def remove_book(self, book_id):
+        """Removes a book and its postings from the index"""
+        self.db.execute(
+            "DELETE FROM postings WHERE chapter_id IN "
+            "(SELECT id FROM chapters WHERE book_id = ?)", (book_id,))
+        self.db.execute("DELETE FROM chapters WHERE book_id = ?", (book_id,))
+        self.db.execute("DELETE FROM books WHERE id = ?", (book_id,))
+
+    def remove_books(self, book_ids):
+        """Removes the books with the given ids and their postings"""
+        for book_id in book_ids:
+            self.remove_book(book_id)
+
+    def add_book(self, path, stat, book, error=None):
+        """Adds a book read by read_book to the index, or the error reading
+        it (without chapters), so that it is only read again once it
+        changes"""
+        title, author, chapters = book or (None, None, [])
+        book_id = self.db.execute(
+            "INSERT INTO books (path, mtime_ns, size, title, author, error) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (path, stat.st_mtime_ns, stat.st_size, title, author,
+             error)).lastrowid
+        for item_id, postings in chapters:
+            chapter_id = self.db.execute(
+                "INSERT INTO chapters (book_id, item_id) VALUES (?, ?)",
+                (book_id, item_id)).lastrowid
+            self.db.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?, ?)",
+                [(self.term_id(term), chapter_id, count, positions)
+                 for term, count, positions in postings])
+
+    def update(self, workers=1):
+        """Indexes the ePubs in the folder that are new or changed since the
+        last update, and forgets the ones that are gone, with the given
+        number of processes reading the books (0 uses every CPU core).
+        Returns the number of (indexed, unchanged, removed) books"""
+        start = time.perf_counter()
+        indexed, unchanged, removed = update_books(
+            self.db, self.folder, _read_or_error, self.add_book,
+            self.remove_books, workers, commit_every=COMMIT_EVERY)
+        print("Indexed {} books ({} unchanged, {} removed) in {:.1f}s".format(
+            indexed, unchanged, removed, time.perf_counter() - start))
+        return (indexed, unchanged, removed)
+
+    def _postings(self, term, positions):
+        """Returns a dictionary of chapter id -> the count of the term in
+        it, or its positions"""
+        column = "positions" if positions else "count"
+        return dict(self.db.execute(
+            "SELECT chapter_id, {} FROM postings JOIN terms "
+            "ON terms.id = term_id WHERE term = ?".format(column), (term,)))
+
+    def _phrase_matches(self, terms):
+        """Returns a dictionary of chapter id -> how often the terms appear
+        right after each other in it"""
+        if len(terms) == 1:
+            return self._postings(terms[0], positions=False)
+        postings = [self._postings(term, positions=True) for term in terms]
+        chapters = set(postings[0])
+        for found in postings[1:]:
+            chapters &= found.keys()
+        matches = {}
+        for chapter in chapters:
+            starts = _phrase_starts(postings[0][chapter], 0)
+            for offset, found in enumerate(postings[1:], 1):
+                starts &= _phrase_starts(found[chapter], offset)
+                if not starts:
+                    break
+            if starts:
+                matches[chapter] = len(starts)
+        return matches
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        """Returns the SearchResults of the chapters that contain every term
+        and "quoted phrase" of the query, with the most matches first"""
+        parts = []
+        for phrase, word in _query_pattern.findall(query):
+            terms = tokenize(phrase or word)
+            if terms:
+                parts.append(terms)
+        if not parts:
+            return []
+
+        scores = None
+        # The shortest parts are the cheapest to look up first
+        for terms in sorted(parts, key=len):
+            matches = self._phrase_matches(terms)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {
+                    chapter: count + matches[chapter]
+                    for chapter, count in scores.items() if chapter in matches}
+            if not scores:
+                return []
+
+        best = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+        results = []
+        for chapter_id, matches in best:
+            path, title, author, item_id = self.db.execute(
+                "SELECT path, title, author, item_id FROM chapters "
+                "JOIN books ON books.id = book_id WHERE chapters.id = ?",
+                (chapter_id,)).fetchone()
+            results.append(SearchResult(path, title, author, item_id, matches))
+        return results
@@ -1,10 +1,10 @@
 # encoding: utf-8
 import os
-from validator import validate
 
 
 def validate_spec(spec, directory=os.getcwd()):
     """Validates the given specification dictionary"""
+    from validator import validate
     members = [
         "title",
         "author",
@@ -0,0 +1,145 @@
+# encoding: utf-8
+"""
+Instrumentation of the compilation: where the time goes and how many bytes
+go in and out of every stage. A Stats object is passed explicitly through
+the compilation, and is the sink of its timings and of its per-item
+messages, which the default (quiet) sink never formats
+"""
+import json
+import time
+import threading
+
+
+# The stages of a compilation, in the order they happen to an entry
+STAGES = (
+    "load", "decode", "markdown", "optimize", "probe", "compress", "write")
+
+
+class _Timer:
+    """Times a block as an item of a stage. Set bytes_in and bytes_out in
+    the block, if they are not known when it starts"""
+    __slots__ = ("stats", "stage", "name", "bytes_in", "bytes_out", "start")
+
+    def __init__(self, stats, stage, name, bytes_in, bytes_out):
+        self.stats = stats
+        self.stage = stage
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.stats.record(
+            self.stage, time.perf_counter() - self.start,
+            self.bytes_in, self.bytes_out, name=self.name)
+
+
+class Stats:
+    """The default sink: collects the count, seconds, bytes in and bytes out
+    of every stage, and ignores the messages. With keep_entries, the
+    measurements of every single item are kept as well.
+    Items may be recorded from several threads"""
+    verbose = False
+
+    def __init__(self, keep_entries=False):
+        self.stages = {}  # stage -> [count, seconds, bytes in, bytes out]
+        self.keep_entries = keep_entries
+        self.entries = []  # [(stage, name, seconds, bytes in, bytes out)]
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent back from worker processes, where the lock is not needed
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def timer(self, stage, name=None, bytes_in=0, bytes_out=0):
+        """Returns a context manager that times its block as the given item
+        of the given stage"""
+        return _Timer(self, stage, name, bytes_in, bytes_out)
+
+    def record(self, stage, seconds, bytes_in=0, bytes_out=0, name=None):
+        """Records an item of the given stage"""
+        with self._lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = [0, 0.0, 0, 0]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += bytes_in
+            totals[3] += bytes_out
+            if self.keep_entries:
+                self.entries.append(
+                    (stage, name, seconds, bytes_in, bytes_out))
+
+    def merge(self, other):
+        """Adds the measurements of another Stats (eg. from a worker)"""
+        with self._lock:
+            for stage, totals_in in other.stages.items():
+                totals = self.stages.setdefault(stage, [0, 0.0, 0, 0])
+                for num, value in enumerate(totals_in):
+                    totals[num] += value
+            if self.keep_entries:
+                self.entries.extend(other.entries)
+
+    def event(self, message, *args):
+        """A per-item message, formatted with the args by verbose sinks"""
+        pass
+
+    def as_dict(self):
+        """Returns the measurements as a JSON serializable dictionary"""
+        stages = {}
+        for stage in sorted(self.stages, key=_stage_order):
+            count, seconds, bytes_in, bytes_out = self.stages[stage]
+            stages[stage] = {
+                "count": count,
+                "seconds": round(seconds, 6),
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+            }
+        result = {"stages": stages}
+        if self.keep_entries:
+            result["entries"] = [
+                {"stage": stage, "name": name, "seconds": round(seconds, 6),
+                 "bytes_in": bytes_in, "bytes_out": bytes_out}
+                for stage, name, seconds, bytes_in, bytes_out in self.entries]
+        return result
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def report(self):
+        """Returns a table of the measurements of every stage"""
+        lines = ["{:10} {:>7} {:>9} {:>11} {:>11}".format(
+            "stage", "items", "seconds", "MB in", "MB out")]
+        for stage in sorted(self.stages, key=_stage_order):
+            count, seconds, bytes_in, bytes_out = self.stages[stage]
+            lines.append("{:10} {:7} {:9.3f} {:11.2f} {:11.2f}".format(
+                stage, count, seconds, bytes_in / 1e6, bytes_out / 1e6))
+        return "\n".join(lines)
+
+
+class VerboseStats(Stats):
+    """A sink that also prints the per-item messages"""
+    verbose = True
+
+    def event(self, message, *args):
+        print("- " + message.format(*args))
+
+
+def _stage_order(stage):
+    return (STAGES.index(stage), stage) if stage in STAGES else (len(STAGES), stage)
+
+
+def call_with_stats(func, args, keep_entries=False):
+    """Calls the function with the args and a fresh Stats, and returns the
+    result with the Stats. Used to collect the measurements of workers"""
+    stats = Stats(keep_entries=keep_entries)
+    return (func(*args, stats=stats), stats)
@@ -0,0 +1,89 @@
+# encoding: utf-8
+"""
+A process-wide registry of the templates used to compile ePubs, so that each
+template file is only read once per process
+"""
+import os
+import time
+from string import Formatter
+
+
+TEMPLATE_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "templates")
+
+# How often (in seconds) a cached template checks whether its file changed
+CHECK_INTERVAL = 1.0
+
+
+_formatter = Formatter()
+
+
+class Template:
+    """A template compiled when loaded to its literal text and fields, which
+    are joined again when it is formatted"""
+    def __init__(self, text, path=None):
+        self.text = text
+        self.path = path
+        # Parsing here makes malformed templates fail on load, not on use
+        self.parts = []  # [(literal text, field name, format spec, conversion)]
+        for literal, field, spec, conversion in _formatter.parse(text):
+            if field is not None and not field:
+                raise Exception("Positional field in template {!r}".format(
+                    path or text))
+            self.parts.append((literal, field, spec, conversion))
+
+    def format_map(self, mapping):
+        """Formats the template with the values of the given mapping, like
+        str.format_map"""
+        pieces = []
+        for literal, field, spec, conversion in self.parts:
+            pieces.append(literal)
+            if field is None:
+                continue
+            if field.isidentifier():
+                value = mapping[field]
+            else:
+                value = _formatter.get_field(field, (), mapping)[0]
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+            if spec:
+                if "{" in spec:
+                    spec = spec.format_map(mapping)
+                value = format(value, spec)
+            elif type(value) is not str:
+                value = format(value)
+            pieces.append(value)
+        return "".join(pieces)
+
+    def format(self, **kwargs):
+        """Formats the template with the given keyword arguments"""
+        return self.format_map(kwargs)
+
+
+_templates = {}  # path -> [mtime, last_checked, Template]
+
+
+def get_template(name):
+    """Returns the template at the given path, or with the given name in the
+    templates folder. Templates are loaded once per process and only read
+    again when the modification time of their file changes"""
+    path = os.path.join(TEMPLATE_DIRECTORY, name)
+    now = time.monotonic()
+    entry = _templates.get(path)
+    if entry is not None and now - entry[1] < CHECK_INTERVAL:
+        return entry[2]
+
+    mtime = os.stat(path).st_mtime_ns
+    if entry is None or entry[0] != mtime:
+        with open(path) as f:
+            text = f.read()
+        entry = [mtime, now, Template(text, path)]
+        _templates[path] = entry
+    else:
+        entry[1] = now
+    return entry[2]
+
+
+def clear_templates():
+    """Forgets every loaded template"""
+    _templates.clear()
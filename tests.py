@@ -1,48 +1,210 @@
 # encoding: utf-8
 import os
-from create_epub import split_and_compile, compile_epub, validate_spec, quick_load
+import sys
+import subprocess
+import pytest
+from compile import split_and_compile, load_source_text
+from compile import compile_epub_from_specification as compile_epub
+from spec_validator import validate_spec
 
 
-def test_split():
-    source = "test_source.md"
-    files = split_and_compile(quick_load(source), source)
-    for (name, html) in files:
-        with open(name, "w") as f:
+# The fixtures of the tests, wherever they are run from
+TEST_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "test")
+
+# Modules that are slow to import, and must only be imported when used
+HEAVY_MODULES = ("markdown", "chardet", "PIL", "toml", "bs4")
+
+
+def imported_modules(*args):
+    """Returns the names of the modules imported by running python with the
+    given arguments, from its -X importtime report"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + list(args),
+        cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    names = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            names.add(line.rsplit("|", 1)[1].strip())
+    return names
+
+
+def assert_not_imported(names):
+    heavy = [name for name in names if name.split(".")[0] in HEAVY_MODULES]
+    assert not heavy, "Imported at startup: {}".format(", ".join(heavy))
+
+
+def test_help_startup():
+    assert_not_imported(imported_modules("main.py", "--help"))
+
+
+def test_library_startup():
+    assert_not_imported(imported_modules(
+        "-c", "import compile, comic, epub, writer, batch, watch, scrape_epub"))
+
+
+def test_split(tmpdir):
+    source = os.path.join(TEST_DIRECTORY, "test_source.md")
+    files = split_and_compile(load_source_text(source))
+    for (_, name, html) in files:
+        with open(str(tmpdir.join(name)), "w") as f:
             f.write(html)
 
 
-def test_compile():
+def test_stream_chapters(tmpdir):
+    """Streaming a source gives exactly the chapters of splitting it whole,
+    also with the headings and line endings at the read buffer boundaries"""
+    import io
+    from compile import split_chapters, stream_chapters
+    size = io.DEFAULT_BUFFER_SIZE
+    for offset in (-3, -2, -1, 0, 1, 2):
+        for ending in ("\n", "\r\n"):
+            text = "Preface before the first heading" + ending
+            for num in range(1, 8):
+                # Fill up to just around the next multiple of the buffer size
+                # (with ascii, so that characters are bytes), then the heading
+                filler = "Text of chapter {}. ".format(num)
+                target = (num * size + offset - len(ending) -
+                          len(text.encode("utf-8")))
+                text += (filler * (target // len(filler) + 1))[:target]
+                text += ending + "# Chapter {} æøå".format(num) + ending
+                text += "## Sub {}".format(num) + ending
+            for tail in ("", ending, "Last line"):
+                path = str(tmpdir.join("source.md"))
+                with open(path, "wb") as f:
+                    f.write((text + tail).encode("utf-8"))
+                assert list(stream_chapters(path)) == list(
+                    split_chapters(load_source_text(path))), (offset, tail)
+
+
+def test_compile_to_stdout():
+    """An ePub written to stdout (a pipe, which is not seekable) is not
+    mixed with the messages of the compilation"""
+    script = (
+        "import sys\n"
+        "from compile import compile_epub\n"
+        "compile_epub('Piped', 'Tester', 'png', {!r}, "
+        "[('Chapter', 'chapter.html', '<p>Text</p>')], "
+        "path=sys.stdout.buffer)\n").format(
+            os.path.join(TEST_DIRECTORY, "test_cover.png"))
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    assert result.stdout[:4] == b"PK\x03\x04", result.stdout[:40]
+
+
+def test_search_phrase(tmpdir):
+    """A query argument quoted in the shell is searched as a phrase"""
+    from compile import compile_epub
+    here = os.path.dirname(os.path.abspath(__file__))
+    cover = os.path.join(TEST_DIRECTORY, "test_cover.png")
+    chapters = [
+        ("Together", "together.html", "<p>The red fox jumps.</p>"),
+        ("Apart", "apart.html", "<p>A red apple and a fox.</p>")]
+    compile_epub("Foxes", "Tester", "png", cover, chapters,
+                 path=str(tmpdir.join("foxes.epub")))
+
+    def run(*args):
+        return subprocess.run(
+            [sys.executable, "main.py"] + list(args), cwd=here,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            universal_newlines=True, check=True).stdout
+
+    run("index", str(tmpdir))
+    found = run("search", str(tmpdir), "red fox")
+    assert "Together" in found and "Apart" not in found, found
+    found = run("search", str(tmpdir), "red", "fox")
+    assert "Together" in found and "Apart" in found, found
+
+
+def test_compile(tmpdir):
+    pytest.importorskip("validator")  # Used by spec_validator, not in the tree
     spec = {
         "title": "The Test of the ePub Creator",
         "author": "Jabok Partulu Nymos",
         "cover_file": "test_cover.png",
-        "source_file": "test_source.md"
+        "source_files": ["test_source.md"]
     }
-    compile_epub(spec, os.getcwd())
+    compile_epub(
+        spec, TEST_DIRECTORY, target_path=str(tmpdir.join("test.epub")))
 
 
 def test_validate():
+    pytest.importorskip("validator")
     valid_spec = {
         "title": "The Test of the ePub Creator",
         "author": "Jabok Partulu Nymos",
         "cover_file": "test_cover.png",
-        "source_file": "test_source.md",
+        "source_files": ["test_source.md"],
         "language": "English",
         "tags": ["fun", "programming", "ePub", "jabok"]
     }
-    validate_spec(valid_spec)
+    validate_spec(valid_spec, TEST_DIRECTORY)
     print("Valid test: PASSED")
 
     invalid_spec = valid_spec
     invalid_spec.update({
         "cover_file": "missing.png",
-        "source_file": "not_there.md",
+        "source_files": ["not_there.md"],
         "description_file": "yeah_right.txt"
     })
     try:
-        validate_spec(invalid_spec)
+        validate_spec(invalid_spec, TEST_DIRECTORY)
         print("NO ERRORS: THIS IS BAD!")
     except Exception as e:
         print("Exception!")
         print(e)
         print("Invalid test: PASSED")
+
+
+def test_soak_many_builds(tmpdir):
+    """Builds many ePubs in one process, which must neither leak entries
+    between the builds nor grow in memory. Set EPUB_SOAK_BUILDS for a
+    longer soak"""
+    import gc
+    import tracemalloc
+    from compile import compile_epub
+    from reader import EpubReader
+    builds = int(os.environ.get("EPUB_SOAK_BUILDS", 300))
+    cover = os.path.join(TEST_DIRECTORY, "test_cover.png")
+    path = str(tmpdir.join("soak.epub"))
+
+    def build(num):
+        chapters = [
+            ("Chapter {}".format(c), "chapter{}.html".format(c),
+             "<p>Build {} chapter {}</p>".format(num, c)) for c in range(3)]
+        compile_epub("Soak {}".format(num), "Tester", "png", cover, chapters,
+                     path=path)
+
+    def snapshot():
+        gc.collect()
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    warmup = min(50, builds // 10)
+    tracemalloc.start()
+    try:
+        for num in range(warmup):
+            build(num)
+        before = snapshot()
+        for num in range(warmup, builds):
+            build(num)
+            if num % 100 == 0 or num == builds - 1:
+                reader = EpubReader(path)
+                try:
+                    assert reader.title == "Soak {}".format(num)
+                    assert len(reader.spine) == 4  # The title page and chapters
+                    assert len(reader.titles()) == 4
+                    assert [m for m, _ in reader.manifest.values()].count(
+                        "cover.png") == 1
+                finally:
+                    reader.close()
+        after = snapshot()
+    finally:
+        tracemalloc.stop()
+    # What is still allocated after the builds, and was not before them
+    growth = sum(stat.size_diff for stat in after.compare_to(before, "lineno"))
+    assert growth < 128 * 1024, "Memory grew by {} bytes".format(growth)
@@ -0,0 +1,130 @@
+# encoding: utf-8
+"""
+Keeps an ePub up to date with its specification: the spec and every file it
+refers to are watched, and the ePub is rebuilt incrementally whenever one of
+them changes. The process stays warm between builds, so only the changed
+chapters and images cost anything.
+"""
+import os
+import time
+import traceback
+
+from compile import compile_epub_from_specification
+
+
+DEFAULT_INTERVAL = 0.2  # Seconds between checking the files for changes
+
+
+def folder_files(folder, listings):
+    """Returns the paths of the files in the folder and its subfolders.
+    The listing of every folder is kept in the given dictionary with the
+    modification time of the folder, and only read again once it changes,
+    which is when files are added to, removed from or renamed in it"""
+    paths = []
+    seen = set()
+    pending = [folder]
+    while pending:
+        dirpath = pending.pop()
+        seen.add(dirpath)
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            continue
+        listing = listings.get(dirpath)
+        if listing is None or listing[0] != mtime:
+            dirnames = []
+            filenames = []
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        # Like os.walk, links to folders are not followed
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                dirnames.append(entry.name)
+                        else:
+                            filenames.append(entry.name)
+            except OSError:
+                continue
+            listing = (mtime, dirnames, filenames)
+            listings[dirpath] = listing
+        _, dirnames, filenames = listing
+        paths.extend(os.path.join(dirpath, name) for name in filenames)
+        pending.extend(os.path.join(dirpath, name) for name in dirnames)
+    for dirpath in [path for path in listings if path not in seen and
+                    path.startswith(os.path.join(folder, ""))]:
+        del listings[dirpath]  # Removed since the last time
+    return paths
+
+
+def watched_paths(spec_file, spec, listings=None):
+    """Returns the paths of the spec file and every file it refers to. The
+    image folders are listed through the given dictionary of listings, see
+    folder_files"""
+    directory = os.path.dirname(os.path.abspath(spec_file))
+    if listings is None:
+        listings = {}
+
+    def local(path):
+        return os.path.join(directory, path)
+
+    paths = [spec_file]
+    for key in ("cover_file", "description_file"):
+        if key in spec:
+            paths.append(local(spec[key]))
+    paths.extend(local(path) for path in spec.get("source_files", []))
+    paths.extend(local(path) for path in spec.get("image_files", {}).values())
+    for folder in spec.get("image_folders", []):
+        paths.extend(folder_files(local(folder), listings))
+    return paths
+
+
+def snapshot(paths):
+    """Returns the modification time and size of the given files, so that
+    two snapshots differ if any file was changed, added or removed"""
+    state = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            state[path] = None
+    return state
+
+
+def watch(spec_file, target_path=None, interval=DEFAULT_INTERVAL, workers=None):
+    """Builds the ePub of the given spec file, and rebuilds it whenever the
+    spec or one of its files changes. Runs until interrupted"""
+    import toml
+    directory = os.path.dirname(os.path.abspath(spec_file))
+    spec = None
+    spec_state = None
+    last_state = None
+    listings = {}  # The listings of the image folders, see folder_files
+    print("Watching {!r} (Ctrl-C to stop)".format(spec_file))
+    while True:
+        # Only parse the spec again when it changed
+        current_spec_state = snapshot([spec_file])
+        if current_spec_state != spec_state:
+            spec_state = current_spec_state
+            try:
+                spec = toml.load(spec_file)
+            except Exception as e:
+                print("! Could not load the spec: {}".format(e))
+                spec = None
+
+        if spec is not None:
+            state = snapshot(watched_paths(spec_file, spec, listings))
+            if state != last_state:
+                last_state = state
+                start = time.perf_counter()
+                try:
+                    target_path = compile_epub_from_specification(
+                        spec, directory, target_path=target_path,
+                        workers=workers, incremental=True)
+                    print("Rebuilt in {:.2f}s".format(
+                        time.perf_counter() - start))
+                except Exception:
+                    traceback.print_exc()
+                    print("! Build failed, waiting for changes")
+
+        time.sleep(interval)
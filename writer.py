@@ -2,9 +2,19 @@
 # Created by Jabok @ Friday July 24th 2015
 """Classes and utilities for writing to ePub files"""
 import os
+import re
+import time
+import zlib
+import sys
+import shutil
+import struct
+import hashlib
 import zipfile
-import io
-from PIL import Image
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from templating import get_template
+from imageinfo import probe_image, probe_bytes
+from stats import Stats
 
 
 def get_local(*path):
@@ -20,6 +30,7 @@ CONTENT_FILENAME = "content.opf"
 CONTAINER_PATH = "META-INF/container.xml"
 MIMETYPE_FILENAME = "mimetype"
 TOC_FILENAME = "toc.ncx"
+XHTML_MEDIA_TYPE = "application/xhtml+xml"
 
 CONTENT_TEMPLATE_FILE = template("content.tpl")
 META_TEMPLATE_FILE = template("meta.tpl")
@@ -29,11 +40,64 @@ TOC_NAV_POINT_TEMPLATE_FILE = template("nav_point.tpl")
 MANIFEST_ITEM_TEMPLATE_FILE = template("manifest_item.tpl")
 SPINE_ITEM_TEMPLATE_FILE = template("spine_item.tpl")
 
+# Media that is already compressed, so deflating it only wastes time
+STORED_EXTENSIONS = (
+    ".jpg", ".jpeg", ".png", ".gif", ".webp",
+    ".mp3", ".mp4", ".m4a", ".woff", ".woff2",
+)
+DEFAULT_COMPRESSION_LEVEL = 6
+# Deflate while writing until a pool of threads is shown to be faster
+DEFAULT_COMPRESSION_THREADS = 1
+
+# How many bytes of entries may wait to be deflated and written at most
+DEFLATE_AHEAD_BYTES = 16 * 1024 * 1024
+
+# How much of a file is copied into the archive at a time
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# The local file header of a zip entry, and where its name and extra lengths are
+_local_header = struct.Struct("<4s2B4HL2L2H")
+_LH_FILENAME_LENGTH = 10
+_LH_EXTRA_FIELD_LENGTH = 11
+_MASK_USE_DATA_DESCRIPTOR = 0x08
+
+# An entry compressed ahead of writing: its compressed data (the raw
+# deflate stream, or the data itself if stored), the crc32 of the data, and
+# the wall and CPU seconds compressing took
+Compressed = namedtuple("Compressed", "data crc seconds cpu_seconds")
+
+
 # Other stuff
+def compress(data, compress_type=zipfile.ZIP_DEFLATED,
+             level=DEFAULT_COMPRESSION_LEVEL):
+    """Compresses the data exactly as ZipFile does for an entry of the given
+    compress type (stored or deflated), so the result can be written as its
+    compressed data. Returns a Compressed.
+    zlib releases the GIL, so entries can be deflated on threads"""
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    else:
+        compressed = data
+    return Compressed(
+        compressed, zlib.crc32(data), time.perf_counter() - start,
+        time.thread_time() - cpu_start)
+
+
+def hash_file(path):
+    """Returns the content hash of the file at the given path"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def get_image_size(imagepath):
     """Returns the size of the given image"""
-    img = Image.open(imagepath)
-    return img.size
+    info = probe_image(imagepath)
+    return (info.width, info.height)
 
 
 def read_description(file):
@@ -76,17 +140,14 @@ _default_metadata = {
 
 def create_content_page(title, cover_file_name, author, chapters, images, metadata=None):
     """Creates the content.opf file of an epub book
-    specs: The specification dictionary of the comic
-    spine: A list of the files in the finished epub
-    directory: Where to put everything
+    chapters: The ManifestItems of the chapters, in spine order
+    images: The ManifestItems of the images
+    metadata: The specification dictionary of the book
     """
     if metadata is None: metadata = {}
     
-    with open(MANIFEST_ITEM_TEMPLATE_FILE) as f:
-        manifest_template = f.read()
-    
-    with open(SPINE_ITEM_TEMPLATE_FILE) as f:
-        spine_template = f.read()
+    manifest_template = get_template(MANIFEST_ITEM_TEMPLATE_FILE)
+    spine_template = get_template(SPINE_ITEM_TEMPLATE_FILE)
     
     # Add optional meta information :)
     meta_lines = []
@@ -95,7 +156,9 @@ def create_content_page(title, cover_file_name, author, chapters, images, metada
     combined_metadata.update(metadata)
     
     for meta_type, value in combined_metadata.items():
-        meta_lines += _meta_handlers[meta_type](value)
+        # The metadata is the whole spec, so skip the non-meta keys
+        if meta_type in _meta_handlers:
+            meta_lines += _meta_handlers[meta_type](value)
     
     extrameta = "\n".join(meta_lines)
     
@@ -116,16 +179,15 @@ def create_content_page(title, cover_file_name, author, chapters, images, metada
         text = spine_template.format_map({"id": item_id})
         spine_lines.append(text)
     
-    add_manifest("title", TITLE_FILENAME, "application/xhtml+xml")
+    add_manifest("title", TITLE_FILENAME, XHTML_MEDIA_TYPE)
     add_spine("title")
     
-    for (local_id, local_file) in chapters:
-        add_manifest(local_id, local_file, "application/xhtml+xml")
-        add_spine(local_id)
+    for item in chapters:
+        add_manifest(item.id, item.href, item.media_type)
+        add_spine(item.id)
     
-    for (local_id, local_file) in images:
-        image_type = get_image_type(local_file)
-        add_manifest(local_id, local_file, image_type)
+    for item in images:
+        add_manifest(item.id, item.href, item.media_type)
     
     add_manifest("ncx", "toc.ncx", "application/x-dtbncx+xml")
     
@@ -140,9 +202,7 @@ def create_content_page(title, cover_file_name, author, chapters, images, metada
         authorformat = author
     
     # Format everything :D
-    with open(CONTENT_TEMPLATE_FILE) as f:
-        content_template = f.read()
-    
+    content_template = get_template(CONTENT_TEMPLATE_FILE)
     content = content_template.format(
         title=title,
         author=author,
@@ -154,13 +214,15 @@ def create_content_page(title, cover_file_name, author, chapters, images, metada
     return content
 
 
-def create_title_page(cover_bytes, cover_file):
-    """Creates a html title page based on the given cover image"""
-    with open(TITLE_TEMPLATE_FILE) as f:
-        template = f.read()
-    
-    image = Image.open(io.BytesIO(cover_bytes))
-    width, height = image.size
+def create_title_page(cover, cover_file):
+    """Creates a html title page based on the given cover image, which is
+    either its bytes or the path to it"""
+    template = get_template(TITLE_TEMPLATE_FILE)
+    if isinstance(cover, bytes):
+        info = probe_bytes(cover)
+    else:
+        info = probe_image(cover)
+    width, height = info.width, info.height
     text = template.format_map({
         "width": width, 
         "height": height, 
@@ -169,36 +231,386 @@ def create_title_page(cover_bytes, cover_file):
     return text
 
 
+class CompressionPolicy:
+    """Decides how each entry of an ePub archive is compressed.
+    Already compressed media is stored as it is, and everything else
+    (xhtml, opf, ncx...) is deflated at the given level, on the given number
+    of threads (0 uses every CPU core, 1 deflates while writing)"""
+    def __init__(
+            self, level=DEFAULT_COMPRESSION_LEVEL,
+            stored_extensions=STORED_EXTENSIONS,
+            threads=DEFAULT_COMPRESSION_THREADS):
+        self.level = level
+        self.stored_extensions = tuple(e.lower() for e in stored_extensions)
+        self.threads = threads
+        self.deflated_bytes = 0
+        self.deflate_seconds = 0.0
+        self.stored_bytes = 0
+
+    @classmethod
+    def from_spec(cls, value):
+        """Creates a policy from the 'compression' value of a specification,
+        which is either missing, a compression level or a table with the
+        optional keys 'level', 'store' (a list of file endings) and
+        'threads'"""
+        if value is None:
+            return cls()
+        elif isinstance(value, cls):
+            return value
+        elif isinstance(value, int):
+            return cls(level=value)
+        else:
+            return cls(
+                level=value.get("level", DEFAULT_COMPRESSION_LEVEL),
+                stored_extensions=value.get("store", STORED_EXTENSIONS),
+                threads=value.get("threads", DEFAULT_COMPRESSION_THREADS))
+
+    def compression_for(self, filename):
+        """Returns the (compress_type, compresslevel) of the given entry"""
+        if zipfile.zlib is None:  # Deflate if possible
+            return (zipfile.ZIP_STORED, None)
+        elif filename == MIMETYPE_FILENAME:
+            return (zipfile.ZIP_STORED, None)
+        elif filename.lower().endswith(self.stored_extensions):
+            return (zipfile.ZIP_STORED, None)
+        else:
+            return (zipfile.ZIP_DEFLATED, self.level)
+
+    def record(self, compress_type, size, seconds):
+        """Records that an entry of the given size was written"""
+        if compress_type == zipfile.ZIP_DEFLATED:
+            self.deflated_bytes += size
+            self.deflate_seconds += seconds
+        else:
+            self.stored_bytes += size
+
+    def estimated_seconds_saved(self):
+        """Estimates the CPU time it would have taken to deflate the stored
+        entries, based on how fast the deflated entries were compressed"""
+        if not self.deflated_bytes:
+            return 0.0
+        return self.stored_bytes * self.deflate_seconds / self.deflated_bytes
+
+    def report(self):
+        """Returns a short summary of the compression of the archive"""
+        return "Stored {:.1f} MB as it was, saving ~{:.2f}s of CPU time".format(
+            self.stored_bytes / 1e6, self.estimated_seconds_saved())
+
+    def thread_count(self):
+        """Returns how many threads to deflate the entries on"""
+        return self.threads or os.cpu_count() or 1
+
+
+class ManifestItem:
+    """An entry in the manifest of an ePub: its id, its path in the archive,
+    its media type and its (uncompressed) size in bytes"""
+    __slots__ = ("id", "href", "media_type", "size")
+
+    def __init__(self, id, href, media_type, size=0):
+        self.id = id
+        self.href = href
+        self.media_type = media_type
+        self.size = size
+
+    def __repr__(self):
+        return "ManifestItem({!r}, {!r}, {!r}, {!r})".format(
+            self.id, self.href, self.media_type, self.size)
+
+
+class RawEntry:
+    """An entry of an existing zip archive, whose data can be copied into
+    another archive as it is, without decompressing and compressing it"""
+    def __init__(self, info, path, data_offset, digest=None):
+        self.info = info  # The ZipInfo of the entry
+        self.path = path  # The path of the archive
+        self.data_offset = data_offset  # Where the compressed data starts
+        self.digest = digest  # The content hash of the entry, if known
+
+    @classmethod
+    def from_archive(cls, archive, name):
+        """Locates the data of the named entry in the given open ZipFile"""
+        info = archive.getinfo(name)
+        with open(archive.filename, "rb") as f:
+            f.seek(info.header_offset)
+            header = _local_header.unpack(f.read(_local_header.size))
+        data_offset = (
+            info.header_offset + _local_header.size +
+            header[_LH_FILENAME_LENGTH] + header[_LH_EXTRA_FIELD_LENGTH])
+        return cls(info, archive.filename, data_offset)
+
+
 class EpubWriter:
-    """An ePub archive open for writing"""
+    """An ePub archive open for writing, to the path of the ePub or to any
+    writable binary stream given as its path. Entries are written to the
+    stream as they are added, and the stream does not need to be seekable.
+    Images are stored once per distinct content: an image with the same
+    content as an earlier one is not stored again, but becomes an alias of
+    it, and the references to it in the chapters added afterwards are
+    rewritten to the stored image. So add the images before the chapters.
+    With more than one compression thread, deflated entries are compressed
+    on a pool of threads, and appended to the archive in the order they
+    were added as they are done"""
     def __init__(self, epub):
         self.source = epub  # The ePub data that this class opens and modifies
-        mode = "a" if os.path.exists(epub.path) else "w"
-        try:  # Deflate if possible
-            self.file = zipfile.ZipFile(
-                epub.path, mode=mode, 
-                compression=zipfile.ZIP_DEFLATED)
-        except Exception:
-            self.file = zipfile.ZipFile(
-                epub.path, mode=mode, 
-                compression=zipfile.ZIP_STORED)
+        self.compression = CompressionPolicy.from_spec(epub.compression)
+        self.stats = epub.stats if epub.stats is not None else Stats()
+        self.payloads = {}  # content hash -> the filename of the stored image
+        self.payload_sizes = set()  # The sizes of the stored images
+        self.aliases = {}  # filename of a duplicate image -> stored filename
+        self._alias_pattern = None
+        self.deduplicated_bytes = 0
+        self.deflate_pool = None
+        threads = self.compression.thread_count()
+        if threads > 1:
+            self.deflate_pool = ThreadPoolExecutor(
+                threads, thread_name_prefix="epub-deflate")
+        self.pending = deque()  # (filename, size, future of the Compressed)
+        self.pending_bytes = 0
+        self.file = zipfile.ZipFile(epub.path, mode="w")
+        # The mimetype must be the first entry and uncompressed
+        self.write(MIMETYPE_FILENAME, "application/epub+zip")
+    
+    
+    def write(self, local_file, data):
+        """Writes the data to the archive as compressed by the policy.
+        Returns the size of the entry"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        compress_type, level = self.compression.compression_for(local_file)
+        if compress_type == zipfile.ZIP_DEFLATED and self.deflate_pool:
+            self.pending.append((
+                local_file, len(data),
+                self.deflate_pool.submit(compress, data, compress_type, level)))
+            self.pending_bytes += len(data)
+            self.write_pending(DEFLATE_AHEAD_BYTES)
+            return len(data)
+        
+        # Compressed before writing, so that the sizes are known up front
+        # even on streams that cannot seek back to the header
+        self.write_pending()
+        self.write_compressed(
+            local_file, compress_type, len(data),
+            compress(data, compress_type, level))
+        return len(data)
+    
+    
+    def write_pending(self, limit=0):
+        """Appends the entries deflated on the pool to the archive in order,
+        as long as they are done. While more than the limit of bytes is
+        pending, it waits for them (by default until all are written)"""
+        while self.pending:
+            local_file, size, future = self.pending[0]
+            if self.pending_bytes <= limit and not future.done():
+                return
+            self.pending.popleft()
+            self.pending_bytes -= size
+            self.write_compressed(
+                local_file, zipfile.ZIP_DEFLATED, size, future.result())
+    
+    
+    def write_compressed(self, local_file, compress_type, size, compressed):
+        """Appends an entry of the given size, whose data is compressed with
+        the compress type already"""
+        start = time.perf_counter()
+        info = zipfile.ZipInfo(local_file, time.localtime(time.time())[:6])
+        info.external_attr = 0o600 << 16
+        info.compress_type = compress_type
+        info.CRC = compressed.crc
+        info.compress_size = len(compressed.data)
+        info.file_size = size
+        self.append_entry(info, [compressed.data])
+        self.compression.record(compress_type, size, compressed.cpu_seconds)
+        stage = "compress" if compress_type == zipfile.ZIP_DEFLATED else "write"
+        self.stats.record(
+            stage, compressed.seconds + time.perf_counter() - start, size,
+            info.compress_size, name=local_file)
+    
+    
+    def append_entry(self, info, chunks):
+        """Appends an entry whose ZipInfo has its CRC and sizes set already,
+        writing the chunks of compressed data. Mirrors what ZipFile does
+        when it writes an entry"""
+        # The sizes are known up front, so no data descriptor follows
+        info.flag_bits &= ~_MASK_USE_DATA_DESCRIPTOR
+        zip64 = max(
+            info.file_size * 1.05, info.compress_size) > zipfile.ZIP64_LIMIT
+        archive = self.file
+        with archive._lock:
+            if archive._seekable:
+                archive.fp.seek(archive.start_dir)
+            info.header_offset = archive.fp.tell()
+            archive._writecheck(info)
+            archive._didModify = True
+            archive.fp.write(info.FileHeader(zip64))
+            for chunk in chunks:
+                archive.fp.write(chunk)
+            archive.start_dir = archive.fp.tell()
+            archive.filelist.append(info)
+            archive.NameToInfo[info.filename] = info
+    
+    
+    def stage_timer(self, local_file, compress_type, size):
+        """Times the writing of an entry as the compress stage if it is
+        deflated, or as the write stage if it is stored"""
+        stage = "compress" if compress_type == zipfile.ZIP_DEFLATED else "write"
+        return self.stats.timer(stage, local_file, bytes_in=size)
+    
+    
+    def open_entry(self, local_file, file_size=None):
+        """Opens a new entry of the archive for writing, so that it can be
+        written in pieces. The data is compressed as given by the policy.
+        Give the file size when it is known, so that only entries that need
+        them get zip64 headers"""
+        compress_type, level = self.compression.compression_for(local_file)
+        info = zipfile.ZipInfo(local_file, time.localtime(time.time())[:6])
+        info.external_attr = 0o600 << 16
+        info.compress_type = compress_type
+        info._compresslevel = level  # Not exposed by ZipInfo before 3.13
+        if file_size is not None:
+            info.file_size = file_size
+        return self.file.open(info, mode="w", force_zip64=file_size is None)
+    
+    
+    def write_from_path(self, local_file, path, digest=None):
+        """Copies the file at the given path into the archive in chunks, so
+        that it is never loaded into memory as a whole. The chunks are also
+        fed to the given hashlib object, if any"""
+        size = os.path.getsize(path)
+        compress_type, _ = self.compression.compression_for(local_file)
+        self.write_pending()
+        with self.stage_timer(local_file, compress_type, size) as timer:
+            start = time.process_time()
+            with open(path, "rb") as src, \
+                    self.open_entry(local_file, size) as dst:
+                if digest is None:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+                else:
+                    for chunk in iter(lambda: src.read(COPY_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        dst.write(chunk)
+            self.compression.record(
+                compress_type, size, time.process_time() - start)
+            timer.bytes_out = self.file.filelist[-1].compress_size
+        return size
+    
+    
+    def write_raw(self, local_file, raw):
+        """Copies the compressed data of the given RawEntry into the archive.
+        Returns the size of the entry"""
+        old = raw.info
+        info = zipfile.ZipInfo(local_file, old.date_time)
+        info.compress_type = old.compress_type
+        info.external_attr = old.external_attr
+        info.CRC = old.CRC
+        info.compress_size = old.compress_size
+        info.file_size = old.file_size
+        info.flag_bits = old.flag_bits
+        
+        def chunks():
+            with open(raw.path, "rb") as src:
+                src.seek(raw.data_offset)
+                remaining = info.compress_size
+                while remaining:
+                    chunk = src.read(min(remaining, COPY_CHUNK_SIZE))
+                    if not chunk:
+                        raise Exception("Truncated entry in {!r}: {!r}".format(
+                            raw.path, old.filename))
+                    yield chunk
+                    remaining -= len(chunk)
+        
+        self.write_pending()
+        with self.stats.timer(
+                "write", local_file, bytes_in=info.compress_size,
+                bytes_out=info.compress_size):
+            self.append_entry(info, chunks())
+        return info.file_size
+    
+    
+    def write_content(self, local_file, content):
+        """Writes text or bytes, or copies a RawEntry, into the archive.
+        Returns the size of the entry"""
+        if isinstance(content, RawEntry):
+            return self.write_raw(local_file, content)
+        else:
+            return self.write(local_file, content)
+    
+    
+    def add_alias(self, local_file, stored_file, size):
+        """Makes the image filename an alias of the stored image"""
+        self.aliases[local_file] = stored_file
+        self._alias_pattern = None
+        self.deduplicated_bytes += size
+        self.stats.event("Duplicate image: {!r} is {!r}", local_file, stored_file)
+    
+    
+    def resolve_aliases(self, text):
+        """Rewrites the references to duplicate images in the chapter text to
+        the images that are stored"""
+        if self._alias_pattern is None:
+            names = "|".join(re.escape(name) for name in self.aliases)
+            self._alias_pattern = re.compile(
+                r"""((?:src|href)\s*=\s*["'])({})(["'])""".format(names))
+        aliases = self.aliases
+        return self._alias_pattern.sub(
+            lambda m: m.group(1) + aliases[m.group(2)] + m.group(3), text)
     
     
     def add_chapter(self, title, local_file, text):
-        """Adds a chapter to the ePub"""
-        self.file.writestr(local_file, text)
-        self.source.chapters.append((title, local_file))
-        print("- Chapter added: {!r}".format(title))
-    
-    
-    def add_image(self, title, local_file, image_bytes):
-        """Adds the given image to the ePub"""
-        if not isinstance(image_bytes, bytes):
+        """Adds a chapter to the ePub. The text may also be a RawEntry of
+        the same chapter in another ePub"""
+        if self.aliases and isinstance(text, str):
+            text = self.resolve_aliases(text)
+        size = self.write_content(local_file, text)
+        self.source.chapters.append(ManifestItem(
+            title, local_file, XHTML_MEDIA_TYPE, size))
+        self.stats.event("Chapter added: {!r}", title)
+    
+    
+    def add_image(self, title, local_file, image_bytes, digest=None):
+        """Adds the given image to the ePub. The image may also be given as a
+        RawEntry of the same image in another ePub. Give the content hash
+        (sha1) of the image if it is known already"""
+        if not isinstance(image_bytes, (bytes, RawEntry)):
             raise Exception("Image bytes should be 'bytes' not a {}".format(
                 type(image_bytes)))
-        self.file.writestr(local_file, image_bytes)
-        self.source.images.append((title, local_file))
-        print("- Image added: {!r}".format(title))
+        if isinstance(image_bytes, bytes):
+            if digest is None:
+                digest = hashlib.sha1(image_bytes).hexdigest()
+            size = len(image_bytes)
+        else:
+            digest = image_bytes.digest
+            size = image_bytes.info.file_size
+        if digest in self.payloads:
+            return self.add_alias(local_file, self.payloads[digest], size)
+        if digest is not None:
+            self.payloads[digest] = local_file
+            self.payload_sizes.add(size)
+        size = self.write_content(local_file, image_bytes)
+        self.source.images.append(ManifestItem(
+            title, local_file, get_image_type(local_file), size))
+        self.stats.event("Image added: {!r}", title)
+    
+    
+    def add_image_from_path(self, title, local_file, path):
+        """Adds the image file at the given path to the ePub, streaming it
+        from the disk. Only a file of the same size as a stored image can
+        have the same content, so only such files are hashed before they
+        are stored; the others are hashed while they are copied"""
+        size = os.path.getsize(path)
+        if size in self.payload_sizes:
+            digest = hash_file(path)
+            if digest in self.payloads:
+                return self.add_alias(local_file, self.payloads[digest], size)
+            size = self.write_from_path(local_file, path)
+        else:
+            hashed = hashlib.sha1()
+            size = self.write_from_path(local_file, path, hashed)
+            digest = hashed.hexdigest()
+        self.payloads[digest] = local_file
+        self.payload_sizes.add(size)
+        self.source.images.append(ManifestItem(
+            title, local_file, get_image_type(local_file), size))
+        self.stats.event("Image added: {!r}", title)
     
     
     def add_cover(self, image_type, image_bytes):
@@ -207,16 +619,27 @@ class EpubWriter:
         self.add_image("cover", cover_file, image_bytes)
         self.source.cover_bytes = image_bytes
         self.source.cover_file = cover_file
-        print("- Added cover")
+        self.stats.event("Added cover")
+    
+    
+    def add_cover_from_path(self, image_type, path):
+        """Uses the image file at the given path as the cover for the ePub"""
+        cover_file = "cover.{}".format(image_type.replace(".", ""))
+        self.add_image_from_path("cover", cover_file, path)
+        self.source.cover_path = path
+        self.source.cover_file = cover_file
+        self.stats.event("Added cover")
     
     
     def compile_title_page(self):
         """Compiles the title page for the ePub"""
-        if self.source.cover_bytes:
-            title_content = create_title_page(
-                self.source.cover_bytes, self.source.cover_file)
-            self.file.writestr(TITLE_FILENAME, title_content)
-        print("- Compiled title page")
+        cover = self.source.cover_bytes or self.source.cover_path
+        if cover:
+            with self.stats.timer("probe", self.source.cover_file):
+                title_content = create_title_page(
+                    cover, self.source.cover_file)
+            self.write(TITLE_FILENAME, title_content)
+        self.stats.event("Compiled title page")
     
     
     def compile_index(self):
@@ -224,17 +647,14 @@ class EpubWriter:
         content = create_content_page(
             self.source.title, self.source.cover_file, self.source.author, 
             self.source.chapters, self.source.images, self.source.metadata)
-        self.file.writestr(CONTENT_FILENAME, content)
-        print("- Compiled index file")
+        self.write(CONTENT_FILENAME, content)
+        self.stats.event("Compiled index file")
     
     
     def compile_table_of_contents(self):
         """Compiles a .ncx table of content for the ePub"""
-        with open(TOC_TEMPLATE_FILE) as f:
-            toc_template = f.read()
-        
-        with open(TOC_NAV_POINT_TEMPLATE_FILE) as f:
-            nav_point_template = f.read()
+        toc_template = get_template(TOC_TEMPLATE_FILE)
+        nav_point_template = get_template(TOC_NAV_POINT_TEMPLATE_FILE)
         
         nav_points = []
         nav_points.append(nav_point_template.format_map({
@@ -242,34 +662,45 @@ class EpubWriter:
             "chapter": "Cover",
             "chapter_file": TITLE_FILENAME,
         }))
-        for num, (title, filename) in enumerate(self.source.chapters, 2):
+        for num, item in enumerate(self.source.chapters, 2):
             nav_points.append(nav_point_template.format_map({
                 "number": num,
-                "chapter": title,
-                "chapter_file": filename,
+                "chapter": item.id,
+                "chapter_file": item.href,
             }))
         text = toc_template.format_map({
             "title": self.source.title,
             "nav_points": "\n".join(nav_points),
         })
-        self.file.writestr(TOC_FILENAME, text)
-        print("- Compiled table of contents")
+        self.write(TOC_FILENAME, text)
+        self.stats.event("Compiled table of contents")
         
     
     def compile_meta(self):
         """Adds the META-INF pointer file"""
-        with open(META_TEMPLATE_FILE) as f:
-            meta_template = f.read()
-        
-        self.file.writestr(CONTAINER_PATH, meta_template)
-        self.file.writestr(MIMETYPE_FILENAME, "application/epub+zip")
-        print("- Compiled metadata pointer file")
+        meta_template = get_template(META_TEMPLATE_FILE)
+        self.write(CONTAINER_PATH, meta_template.text)
+        self.stats.event("Compiled metadata pointer file")
     
     
     def close(self):
-        """Compiles the index and meta files and closes the underlying archive"""
-        self.compile_title_page()
-        self.compile_index()
-        self.compile_meta()
-        self.compile_table_of_contents()
-        self.file.close()
\ No newline at end of file
+        """Compiles the index and meta files and closes the underlying
+        archive, which is closed even if compiling them fails. The reports
+        go to stderr, so that they never mix with an ePub written to stdout"""
+        try:
+            self.compile_title_page()
+            self.compile_index()
+            self.compile_meta()
+            self.compile_table_of_contents()
+            self.write_pending()
+        finally:
+            try:
+                if self.deflate_pool is not None:
+                    self.deflate_pool.shutdown(cancel_futures=True)
+            finally:
+                self.file.close()
+        print(self.compression.report(), file=sys.stderr)
+        if self.aliases:
+            print("Stored {} duplicate images once, saving {:.2f} MB".format(
+                len(self.aliases), self.deduplicated_bytes / 1e6),
+                file=sys.stderr)
\ No newline at end of file